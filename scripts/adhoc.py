@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import re
+from collections import namedtuple
 
 def parse_argument_value(value):
     try:
@@ -67,6 +68,38 @@ def load_config(config_file):
         return load_yaml(config_file)
     return {}
 
+# キー指定 'a|b|=default' の解析結果をキャッシュする
+
+_KEY, _DEFAULT, _UNSET = 0, 1, 2
+_compiled_keys = {}
+
+def compile_key(key: str):
+    """Parses a key spec such as 'temperature|temp|=0.2' into a lookup plan (memoised)."""
+    plan = _compiled_keys.get(key)
+    if plan is None:
+        plan = []
+        for name in key.split('|'):
+            if name.startswith('='):
+                plan.append((_DEFAULT, name, parse_argument_value(name[1:])))
+                break
+            if name.startswith('!'):
+                plan.append((_UNSET, name, None))
+                break
+            plan.append((_KEY, name, name.upper()))
+        plan = tuple(plan)
+        _compiled_keys[key] = plan
+    return plan
+
+_view_types = {}
+
+def _view_type(keys):
+    view_type = _view_types.get(keys)
+    if view_type is None:
+        names = [re.sub(r'\W', '_', key.partition('|')[0]) for key in keys]
+        view_type = namedtuple('AdhocView', names, rename=True)
+        _view_types[keys] = view_type
+    return view_type
+
 class AdhocArguments(object):
     """
     アドホックな引数パラメータ
@@ -75,6 +108,7 @@ class AdhocArguments(object):
         self._args = {}
         self._used_keys = set()
         self._use_environ = use_environ
+        self._environ = dict(os.environ) if use_environ else {}
         for key, value in args.items():
             if key == expand_config:
                 self.load_config(value)
@@ -87,8 +121,8 @@ class AdhocArguments(object):
                     continue
                 if use_environ:
                     environ_key = key.upper()
-                    if environ_key in os.environ:
-                        value = parse_argument_value(os.environ[environ_key])
+                    if environ_key in self._environ:
+                        value = parse_argument_value(self._environ[environ_key])
                 if isinstance(value, tuple) and len(value)==1:
                     print(f'Option {key} is required. {value[0]}')
                     lost_found = True
@@ -102,24 +136,29 @@ class AdhocArguments(object):
         return repr(self._args)
 
     def __getitem__(self, key):
-        keys = key.split('|')
-        for key in keys:
-            if key in self._args:
-                self._used_keys.add(key)
-                return self._args[key]
-            if key.startswith('='):
-                return parse_argument_value(key[1:])
-            if key.startswith('!'):
-                raise ValueError(f'{key[0]} is unset.')
-            if self._use_environ:
-                environ_key = key.upper()
-                if environ_key in os.environ:
-                    value = parse_argument_value(os.environ[environ_key])
-                    self._used_keys.add(key)
-                    self._args[key] = value
+        for kind, name, value in compile_key(key):
+            if kind == _KEY:
+                if name in self._args:
+                    self._used_keys.add(name)
+                    return self._args[name]
+                if value in self._environ:
+                    value = parse_argument_value(self._environ[value])
+                    self._used_keys.add(name)
+                    self._args[name] = value
                     return value
+            elif kind == _DEFAULT:
+                return value
+            else:
+                raise ValueError(f'{key} is unset.')
         return None
 
+    def view(self, *keys):
+        """
+        Returns a frozen view of resolved values for inner loops.
+        e.g. view = args.view('temperature|=0.2', 'top_p|=0.95'); view.temperature
+        """
+        return _view_type(keys)(*(self[key] for key in keys))
+
     def __setitem__(self, key, value):
         self._args[key] = value
         setattr(self, key, value)
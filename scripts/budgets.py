@@ -0,0 +1,176 @@
+from typing import List
+import json
+
+# =====================
+# Token and Cost Budget
+# =====================
+#
+# 推論前に未処理のレコードのトークン数を見積もり、価格表から費用を予測する。
+# 推論中はレコードごとの usage (API の返すトークン数、なければ手元での見積もり) を集計し、
+# --max_tokens_budget または --max_cost を超えそうになったら推論を打ち切る。
+#
+# 価格は 100万トークンあたりの値
+# --input_price 2.5 --output_price 10
+# --price_table prices.json  {"gpt-4o": {"input": 2.5, "output": 10}, "anthropic.claude-3-haiku": {...}}
+
+def find_price(model_name: str, price_table: dict):
+    """Looks up the price of the model (exact match, otherwise the longest matching prefix)."""
+    if model_name in price_table:
+        return price_table[model_name]
+    matched = [key for key in price_table if model_name.startswith(key)]
+    if len(matched) > 0:
+        return price_table[max(matched, key=len)]
+    return None
+
+def load_prices(model_name: str, args):
+    input_price = args['input_price']
+    output_price = args['output_price']
+    if input_price is not None or output_price is not None:
+        return {'input': float(input_price or 0), 'output': float(output_price or 0)}
+    price_table = args['price_table']
+    if price_table is None:
+        return None
+    if isinstance(price_table, str):
+        with open(price_table, encoding='utf-8') as f:
+            price_table = json.load(f)
+    price = find_price(model_name, price_table)
+    if price is None:
+        args.utils_print(f'価格表にモデルがありません//No price for {model_name}')
+    return price
+
+class BudgetController(object):
+
+    def __init__(self, model, args, n=1):
+        self.model = model
+        self.args = args
+        self.n = n
+        self.max_tokens = args['max_tokens_budget']
+        self.max_cost = args['max_cost']
+        self.prices = load_prices(str(model), args)
+        if self.max_cost is not None and self.prices is None:
+            # 価格がわからないと費用を計算できず、上限が効かない
+            raise ValueError(f'max_cost requires prices for {model} (specify --input_price/--output_price or --price_table)')
+        self.output_tokens_per_sample = args['expected_output_tokens|max_new_tokens|max_tokens|=512']
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.estimated_records = 0
+        self.prompt_tokens = {}
+        self.projection = None
+        self.exhausted = False
+        self.started = False
+
+    @property
+    def enforced(self):
+        return self.max_tokens is not None or self.max_cost is not None
+
+    @property
+    def enabled(self):
+        return self.enforced or self.prices is not None or self.args['estimate_cost|=false']
+
+    def cost(self, input_tokens, output_tokens):
+        if self.prices is None:
+            return None
+        return (input_tokens * self.prices.get('input', 0) + output_tokens * self.prices.get('output', 0)) / 1_000_000
+
+    def record_tokens(self, record: dict, estimate=True):
+        """
+        Returns (input_tokens, output_tokens, estimated) used by the record.
+        Counts the API does not report (HF models, cut streams) are estimated locally unless estimate=False.
+        """
+        usage = record.get('usage') or []
+        estimated = any(u.get('estimated') for u in usage)
+        input_tokens = sum(u.get('input_tokens') or 0 for u in usage)
+        output_tokens = sum(u.get('output_tokens') or 0 for u in usage)
+        if len(usage) == 0 or any(u.get('input_tokens') is None for u in usage):
+            if estimate:
+                input_tokens = self.model.count_prompt_tokens([record.get('model_input', '')])[0]
+                if self.model.prompt_per_sample:
+                    input_tokens *= self.n
+            estimated = True
+        if len(usage) == 0 or any(u.get('output_tokens') is None for u in usage):
+            if estimate:
+                output_tokens = sum(self.model.estimate_tokens(record.get('model_outputs', [])))
+            estimated = True
+        return input_tokens, output_tokens, estimated
+
+    def start(self, records: List[dict], pending: List[int]):
+        """
+        Accounts the records already generated and projects the tokens and cost of the pending ones.
+        The projection is made (and printed) only on the first call; later calls (batches, shards) only register the prompts.
+        """
+        first = not self.started
+        if first:
+            # 再開時は生成済みのレコードの分も数える (usage がないものは予算を使う場合のみ見積もる)
+            for record in records:
+                if 'model_outputs' in record and ('usage' in record or self.enabled):
+                    input_tokens, output_tokens, _ = self.record_tokens(record, estimate=self.enabled)
+                    self.input_tokens += input_tokens
+                    self.output_tokens += output_tokens
+            self.started = True
+        if not self.enabled:
+            return None
+        pending = [i for i in pending if 'model_outputs' not in records[i]]
+        lengths = self.model.count_prompt_tokens([records[i]['model_input'] for i in pending])
+        for i, num_tokens in zip(pending, lengths):
+            self.prompt_tokens[records[i]['unique_id']] = num_tokens
+        if not first:
+            return self.projection
+        input_tokens = sum(lengths) * (self.n if self.model.prompt_per_sample else 1)
+        output_tokens = sum(min(records[i].get('max_new_tokens') or self.output_tokens_per_sample, self.output_tokens_per_sample) * self.n
+                            for i in pending)
+        self.projection = {'records': len(pending), 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+        message = f'見積もり//Projected: {len(pending)} records input={input_tokens} output<={output_tokens} tokens'
+        projected_cost = self.cost(input_tokens, output_tokens)
+        if projected_cost is not None:
+            self.projection['cost'] = projected_cost
+            message += f' cost<={projected_cost:.4f}'
+        self.args.verbose_print(message)
+        if self.max_tokens is not None and self.input_tokens + input_tokens + output_tokens > self.max_tokens:
+            self.args.utils_print(f'トークン予算を超える見込みです//Projected tokens exceed max_tokens_budget={self.max_tokens}')
+        if self.max_cost is not None and projected_cost is not None and self.spent_cost() + projected_cost > self.max_cost:
+            self.args.utils_print(f'費用の上限を超える見込みです//Projected cost exceeds max_cost={self.max_cost}')
+        return self.projection
+
+    def spent_cost(self):
+        return self.cost(self.input_tokens, self.output_tokens) or 0.0
+
+    def allows(self, record: dict) -> bool:
+        """Checks whether generating the record (with the expected output tokens) stays within the budget."""
+        if not self.enforced:
+            return True
+        prompt_tokens = self.prompt_tokens.pop(record['unique_id'], None)
+        if prompt_tokens is None:
+            prompt_tokens = self.model.count_prompt_tokens([record['model_input']])[0]
+        input_tokens = prompt_tokens * (self.n if self.model.prompt_per_sample else 1)
+        output_tokens = min(record.get('max_new_tokens') or self.output_tokens_per_sample, self.output_tokens_per_sample) * self.n
+        if self.max_tokens is not None and self.input_tokens + self.output_tokens + input_tokens + output_tokens > self.max_tokens:
+            self.exhausted = True
+        next_cost = self.cost(input_tokens, output_tokens)
+        if self.max_cost is not None and next_cost is not None and self.spent_cost() + next_cost > self.max_cost:
+            self.exhausted = True
+        if self.exhausted:
+            self.args.utils_print(f'予算の上限に達したので推論を打ち切ります//Budget exhausted: {self.summary()}')
+        return not self.exhausted
+
+    def charge(self, record: dict):
+        # 予算や価格を使わない場合は、API の返したトークン数を集計するだけで手元では数えない
+        input_tokens, output_tokens, estimated = self.record_tokens(record, estimate=self.enabled)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.estimated_records += int(estimated and self.enabled)
+        cost = self.cost(input_tokens, output_tokens)
+        if cost is not None:
+            record['cost'] = cost
+
+    def summary(self) -> dict:
+        summary = {'input_tokens': self.input_tokens, 'output_tokens': self.output_tokens}
+        if self.prices is not None:
+            summary['cost'] = self.spent_cost()
+            summary['prices'] = self.prices
+        if self.estimated_records > 0:
+            summary['estimated_records'] = self.estimated_records
+        if self.projection is not None:
+            summary['projected'] = self.projection
+        if self.exhausted:
+            summary['exhausted'] = True
+        return summary
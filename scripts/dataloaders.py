@@ -1,5 +1,201 @@
 import json
+import os
+import mmap
+import struct
+import hashlib
+from array import array
 from datasets import load_dataset
+from records import is_columnar, read_table, load_columnar, guess_uniquekey, open_records, strip_compression
+
+# =====================
+# On-disk Dataset Index
+# =====================
+#
+# データセットの横に unique_id → 行番号 のハッシュ表 (オープンアドレス法) と
+# 各行のバイトオフセット、unique_id の一覧を保存し、メモリマップして O(1) で参照する
+# 結果のレコードを作るとき (new_records) は、行を読まずに unique_id の一覧だけを使う
+#
+# header: magic, source size, source mtime_ns, rows, table size, key length, key (8バイト境界まで)
+# offsets: uint64 x (rows + 1)
+# table: (uint64 hash, uint64 row) x table size
+# id offsets: uint64 x (rows + 1), ids: JSON でエンコードした unique_id を連結したもの
+
+_INDEX_MAGIC = b'LMCIDX02'
+_INDEX_HEADER = struct.Struct('<8sQQQQQ')
+
+def _hash_key(key) -> int:
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1  # 0 は空きスロット
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+class DatasetIndex(object):
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self.mtime, self.rows, self.table_size, key_length = _INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != _INDEX_MAGIC:
+            raise ValueError(f'Not a dataset index: {index_path}')
+        start = _INDEX_HEADER.size
+        self.idkey = self.mm[start:start+key_length].decode('utf-8')
+        start += (key_length + 7) // 8 * 8
+        self.offsets = memoryview(self.mm)[start:start + 8 * (self.rows + 1)].cast('Q')
+        start += 8 * (self.rows + 1)
+        self.table = memoryview(self.mm)[start:start + 16 * self.table_size].cast('Q')
+        start += 16 * self.table_size
+        self.id_offsets = memoryview(self.mm)[start:start + 8 * (self.rows + 1)].cast('Q')
+        self.ids_start = start + 8 * (self.rows + 1)
+
+    @classmethod
+    def open(cls, index_path, stamp):
+        """Opens the index if it exists and matches the source file (otherwise None)."""
+        if not os.path.exists(index_path):
+            return None
+        try:
+            index = cls(index_path)
+        except ValueError:
+            return None  # 古い形式のインデックスは作り直す
+        return index if index.is_valid(stamp) else None
+
+    @classmethod
+    def build(cls, index_path, stamp, idkey, keys, offsets):
+        """Builds the index file from the unique_ids and the byte offsets of the rows."""
+        rows = len(offsets) - 1
+        table_size = 1 << max(2 * rows, 1).bit_length()
+        table = array('Q', bytes(16 * table_size))
+        mask = table_size - 1
+        for row, key in enumerate(keys):
+            hashed = _hash_key(key)
+            slot = hashed & mask
+            while table[2 * slot] != 0:
+                slot = (slot + 1) & mask
+            table[2 * slot] = hashed
+            table[2 * slot + 1] = row
+        key_bytes = idkey.encode('utf-8')
+        padding = b'\0' * ((len(key_bytes) + 7) // 8 * 8 - len(key_bytes))
+        ids = [json.dumps(key, ensure_ascii=False).encode('utf-8') for key in keys]
+        id_offsets = [0]
+        for encoded in ids:
+            id_offsets.append(id_offsets[-1] + len(encoded))
+        with open(index_path + '.tmp', 'wb') as w:
+            w.write(_INDEX_HEADER.pack(_INDEX_MAGIC, stamp[0], stamp[1], rows, table_size, len(key_bytes)))
+            w.write(key_bytes + padding)
+            w.write(array('Q', offsets).tobytes())
+            w.write(table.tobytes())
+            w.write(array('Q', id_offsets).tobytes())
+            w.write(b''.join(ids))
+        os.replace(index_path + '.tmp', index_path)
+        return cls(index_path)
+
+    def is_valid(self, stamp):
+        return (self.size, self.mtime) == tuple(stamp)
+
+    def unique_ids(self) -> list:
+        """Returns the unique_id of every row without reading the rows."""
+        start = self.ids_start
+        ids = self.mm[start:start + self.id_offsets[self.rows]]
+        return [json.loads(ids[self.id_offsets[i]:self.id_offsets[i + 1]]) for i in range(self.rows)]
+
+    def candidates(self, key):
+        """Yields the rows whose unique_id hash matches the key (callers check the row itself)."""
+        hashed = _hash_key(key)
+        mask = self.table_size - 1
+        slot = hashed & mask
+        while self.table[2 * slot] != 0:
+            if self.table[2 * slot] == hashed:
+                yield self.table[2 * slot + 1]
+            slot = (slot + 1) & mask
+
+class IndexedJsonlDataset(object):
+    """
+    JSONL データセットをリストに読み込まず、インデックスを使って行単位で参照する
+    """
+
+    def __init__(self, dataset_path):
+        self.dataset_path = dataset_path
+        stamp = _source_stamp(dataset_path)
+        self.mm = None
+        if stamp[0] > 0:
+            # 空のファイルはメモリマップできない
+            with open(dataset_path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_path = dataset_path + '.idx'
+        self.index = DatasetIndex.open(index_path, stamp)
+        if self.index is None:
+            self.index = self.build_index(index_path, stamp)
+
+    def build_index(self, index_path, stamp):
+        offsets = []
+        keys = []
+        idkey = None
+        position = 0
+        for line in (iter(self.mm.readline, b'') if self.mm is not None else []):
+            if line.strip():
+                row = json.loads(line)
+                if idkey is None:
+                    idkey = guess_uniquekey([row]) or ''
+                offsets.append(position)
+                keys.append(row.get(idkey, f'index/{len(keys)}') if idkey else f'index/{len(keys)}')
+            position += len(line)
+        offsets.append(position)
+        if self.mm is not None:
+            self.mm.seek(0)
+        return DatasetIndex.build(index_path, stamp, idkey or '', keys, offsets)
+
+    def __len__(self):
+        return self.index.rows
+
+    def unique_ids(self) -> list:
+        return self.index.unique_ids()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self.mm[self.index.offsets[i]:self.index.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get(self, unique_id, default=None):
+        """Fetches the row by unique_id in O(1)."""
+        for row in self.index.candidates(unique_id):
+            data = self[row]
+            if self.index.idkey == '' or str(data.get(self.index.idkey)) == str(unique_id):
+                return data
+        return default
+
+class IndexedHFDataset(IndexedJsonlDataset):
+    """
+    HuggingFace データセット (Arrow 形式でメモリマップ済み) を行単位で参照する
+    インデックスは Arrow キャッシュファイルの横に保存する
+    """
+
+    def __init__(self, hfdataset):
+        self.hfdataset = hfdataset
+        cache_file = hfdataset.cache_files[0]['filename']
+        index_path = cache_file + '.idx'
+        stamp = _source_stamp(cache_file)
+        self.index = DatasetIndex.open(index_path, stamp)
+        if self.index is None:
+            idkey = (guess_uniquekey([hfdataset[0]]) if len(hfdataset) > 0 else None) or ''
+            if idkey:
+                keys = hfdataset[idkey]
+            else:
+                keys = [f'index/{n}' for n in range(len(hfdataset))]
+            self.index = DatasetIndex.build(index_path, stamp, idkey, keys, list(range(len(hfdataset) + 1)))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return dict(self.hfdataset[i])
 
 def load_testdata(dataset_path: str, args):
     dataset = []
@@ -18,22 +214,42 @@ def load_testdata(dataset_path: str, args):
 def load_jsonl(dataset_path:str, args):
     dataset = []
     try:
-        with open(dataset_path, 'r') as f:
-            dataset = [json.loads(line.strip()) for line in f]
+        if args['dataset_index|=false'] and dataset_path.endswith('.jsonl'):
+            dataset = IndexedJsonlDataset(dataset_path)
+        else:
+            with open_records(dataset_path, 'r') as f:
+                dataset = [json.loads(line.strip()) for line in f if line.strip()]
     except FileNotFoundError:
         raise FileNotFoundError(f"The file {dataset_path} does not exist.")
     if '/' in dataset_path:
         _, _, dataset_path = dataset_path.rpartition('/')
-    args['_dataset_id'] = dataset_path.replace('.jsonl', '')
+    args['_dataset_id'] = strip_compression(dataset_path).replace('.jsonl', '')
+    return dataset
+
+def load_columnar_dataset(dataset_path:str, args):
+    table = read_table(dataset_path)
+    if 'extra' in table.column_names:
+        # lm-chaineval-harness の結果ファイル
+        dataset = load_columnar(dataset_path)
+    else:
+        dataset = table.to_pylist()
+    if '/' in dataset_path:
+        _, _, dataset_path = dataset_path.rpartition('/')
+    args['_dataset_id'] = dataset_path.rpartition('.')[0]
     return dataset
 
 def load_hfdataset(dataset_path:str, args):
+    use_index = args['dataset_index|=false']
     subargs = args.subset(prefix='dataset_')
+    subargs.pop('index', None)
     if 'split' not in subargs:
         subargs['split'] = args['split|=test']
     dataset = load_dataset(dataset_path, **subargs)
     args.verbose_print(dataset_path, dataset)
-    dataset = [{k: v for k, v in item.items()} for item in dataset]
+    if use_index and len(dataset.cache_files) > 0:
+        dataset = IndexedHFDataset(dataset)
+    else:
+        dataset = [{k: v for k, v in item.items()} for item in dataset]
     if '/' in dataset_path:
         _, _, dataset_path = dataset_path.rpartition('/')
     if 'name' in subargs:
@@ -46,8 +262,10 @@ def load_dict(args):
     dataset_path = args['dataset|evaldata']
     if dataset_path is None:
         return load_testdata('dummy_testdata', args)
-    elif dataset_path.endswith(".jsonl"):
+    elif strip_compression(dataset_path).endswith(".jsonl"):
         return load_jsonl(dataset_path, args)
+    elif is_columnar(dataset_path):
+        return load_columnar_dataset(dataset_path, args)
     else:
         return load_hfdataset(dataset_path, args)
 
@@ -55,6 +273,8 @@ def load_evaldata(args):
     dataset_path = args['dataset|evaldata']
     dataset = load_dict(args)
     dataset_id = args['_dataset_id']
+    if len(dataset) == 0:
+        raise ValueError(f'The dataset {dataset_path} is empty.')
     dumpdata = json.dumps(dataset[0], indent=4, ensure_ascii=False)
     args.verbose_print(f'データセットの確認 {dataset_path}[{dataset_id}] {len(dataset)} entries\n{dumpdata}')
     return dataset
@@ -1,7 +1,22 @@
-from evaluate import load
 import os
 import re
+import string
+import json
+import hashlib
+import sqlite3
+import time
 from tqdm import tqdm
+from profiling import profiling_enabled, profile_stage
+from stages import stamp_metric
+from sandbox import SandboxPool, CompileCache, EXECUTABLE_LANGUAGES
+
+try:
+    from evaluate import load
+except ModuleNotFoundError:
+    ## モジュールが見つからない場合は、
+    ## evaluate を使う評価尺度を実行するまでエラーを出さない
+    load = None
+
 os.environ["HF_ALLOW_CODE_EVAL"] = "1"
 
 # =====================
@@ -15,26 +30,39 @@ class Evaluator(object):
     Base class for evaluators that use a model to obtain answers for generated prompts,
     evaluate them based on specified metrics, and calculate scores.
     """
+    version = 1       # 採点方法を変えたら上げる (保存済みのスコアが再計算される)
+    output_keys = ()  # metric_id 以外にレコードに書き込むキー
 
     def __init__(self, metric_id:str, args:dict, load_path:str = None):
         self.metric_id = metric_id # pass@1 pass@2
+        if load_path is not None and load is None:
+            args.raise_uninstalled_module('evaluate')
         self.eval = None if load_path is None else load(load_path)  # code_eval
         self.args = args
 
     def __repr__(self):
         return self.metric_id
 
+    def fingerprint(self):
+        return f'{type(self).__name__}/{self.metric_id}/v{self.version}'
+
     def score_item(self, item):
         item[self.metric_id] = 0.0
 
+    def evaluate_record(self, record):
+        """Scores the record unless it already has the score, and stamps its fingerprint."""
+        if self.metric_id not in record:
+            with profile_stage(record, self.metric_id):
+                self.score_item(record)
+            stamp_metric(record, self)
+
     def score(self, records):
         score=0.0
         n = 0
         if self.eval:
             self.args.verbose_print(f'[{self.metric_id}] {self.eval.description}')
         for record in tqdm(records, desc=f'{self.metric_id}={(score/max(n,1)):.3f}'):
-            if self.metric_id not in record:
-                self.score_item(record)
+            self.evaluate_record(record)
             score += record[self.metric_id]
             n+=1
         return {self.metric_id: score}
@@ -54,26 +82,347 @@ def humaneval_extract(prompt, generated_text):
     return prompt + "\n" + generated_text[:min_stop_index]
 
 
+# MultiPL-E 形式 (C++/JavaScript) の停止文字列
+# テストが関数を閉じる } から始まる場合は、生成された } も取り除く
+MULTIPLE_STOP_SEQUENCES = {
+    'cpp': [],
+    'js': ["\nfunction ", "\n/*", "\n//", "\nconsole.log"],
+}
+
+def multiple_extract(prompt, generated_text, language, test=''):
+    stop_sequences = MULTIPLE_STOP_SEQUENCES.get(language, [])
+    if test.lstrip().startswith('}'):
+        stop_sequences = stop_sequences + ["\n}"]
+    min_stop_index = len(generated_text)
+    for seq in stop_sequences:
+        stop_index = generated_text.find(seq)
+        if stop_index != -1 and stop_index < min_stop_index:
+            min_stop_index = stop_index
+    return prompt + generated_text[:min_stop_index]
+
+def estimate_pass_at_k(num_samples, num_correct, k):
+    """Unbiased pass@k estimator (Chen et al., 2021), the same as code_eval."""
+    if num_samples < k:
+        # サンプル数が k 未満では pass@k を推定できない
+        raise ValueError(f'pass@{k} requires at least {k} samples, but got {num_samples} (set --n {k} or more)')
+    if num_samples - num_correct < k:
+        return 1.0
+    prob = 1.0
+    for i in range(num_samples - num_correct + 1, num_samples + 1):
+        prob *= 1.0 - k / i
+    return 1.0 - prob
+
+def normalize_code(code: str) -> str:
+    """Normalizes a program for cache keys (trailing spaces and blank lines are ignored)."""
+    lines = [line.rstrip() for line in code.strip().splitlines()]
+    return '\n'.join(line for line in lines if line != '')
+
+# 実行環境の問題による一時的な失敗 (サンドボックスのワーカーのクラッシュ、コンパイルのタイムアウトなど)
+TRANSIENT_FAILURES = ('failed: sandbox', 'failed: compilation timed out')
+
+class ExecutionCache(object):
+    """
+    実行結果の永続キャッシュ (SQLite)
+    (実行環境, プログラム, テスト) のハッシュをキーとし、最後に使われた順 (LRU) で削除する。
+    実行環境 (context) は言語、資源制限、コンパイラの設定など、結果を変える設定である。
+    合格・不合格の結果だけをキャッシュし、タイムアウトやワーカーのクラッシュなどの一時的な失敗はキャッシュしない。
+    """
+
+    def __init__(self, cache_path, max_size=100000, context=None):
+        directory = os.path.dirname(cache_path)
+        if not os.path.exists(directory) and directory != '':
+            os.makedirs(directory)
+        self.max_size = max_size
+        self.context = json.dumps(context or {}, sort_keys=True)
+        self.conn = sqlite3.connect(cache_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(key TEXT PRIMARY KEY, passed INTEGER, result TEXT, last_used REAL)')
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, code, test):
+        digest = hashlib.sha256()
+        digest.update(self.context.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(normalize_code(code).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(normalize_code(test).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, code, test):
+        key = self.key(code, test)
+        row = self.conn.execute('SELECT passed, result FROM results WHERE key=?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE results SET last_used=? WHERE key=?', (time.time(), key))
+        return {'passed': bool(row[0]), 'result': row[1]}
+
+    @staticmethod
+    def is_outcome(result: dict) -> bool:
+        """Whether the result is a real pass/fail of the program (not a transient failure of the executor)."""
+        if result['passed']:
+            return True
+        return result['result'].startswith('failed') and not result['result'].startswith(TRANSIENT_FAILURES)
+
+    def put(self, code, test, result: dict):
+        if not self.is_outcome(result):
+            return
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                          (self.key(code, test), int(result['passed']), result['result'], time.time()))
+
+    def commit(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        if count > self.max_size:
+            self.conn.execute('DELETE FROM results WHERE key IN '
+                              '(SELECT key FROM results ORDER BY last_used LIMIT ?)', (count - self.max_size,))
+        self.conn.commit()
+
 class CodeEvalEvaluator(Evaluator):
     """
     コード評価用Evaluatorクラス。HuggingFaceのevaluate-metric/code_evalを使用してスコアを算出する。
     """
+    output_keys = ('code_eval_results', 'generated_code')
+    language = 'py'
 
-    def score_item(self, record):
-        test_cases = [record['reference']]
+    def __init__(self, metric_id:str, args:dict, load_path:str = None, sandbox=False):
+        self.sandbox = None
+        if sandbox or args['sandbox|=false']:
+            # サンドボックスで実行する場合は code_eval を使わない
+            self.sandbox = SandboxPool.from_args(args)
+            load_path = None
+        super().__init__(metric_id, args, load_path=load_path)
+        self.k = int(metric_id.partition('@')[2])
+        n = args['num_return_sequences|n|N|=1']
+        if n < self.k:
+            # 推論を始める前に止める (code_eval と同じく n >= k が必要)
+            raise ValueError(f'{metric_id} requires num_return_sequences (n) >= {self.k}, but n={n}')
+        self.compact = args['compact_records|=false']
+        cache_path = args['eval_cache']
+        self.cache = None
+        if cache_path:
+            self.cache = ExecutionCache(cache_path, max_size=args['eval_cache_size|=100000'], 
+                                        context=self.execution_context())
+
+    def execution_context(self) -> dict:
+        """Returns the settings that change execution results (part of the execution cache key)."""
+        if self.sandbox:
+            return {'language': self.language, 'timeout': self.sandbox.timeout, 'limits': self.sandbox.limits}
+        return {'language': self.language, 'executor': 'code_eval'}
+
+    def run_programs(self, programs: list, test: str) -> list:
+        """Executes candidate programs against the test and returns their results."""
+        if self.sandbox:
+            # code_eval と同じく、候補プログラムの後にテストをつなげて実行する
+            return self.run_sources([program + '\n' + test for program in programs])
+        _, results = self.eval.compute(references=[test], predictions=[programs], k=[1])
+        return [result for _, result in sorted(results[0])]
+
+    def run_sources(self, sources: list) -> list:
+        """Executes complete programs (candidate + test) in the sandbox."""
+        return self.sandbox.run_programs(sources)
+
+    def execute_pairs(self, pairs: list) -> list:
+        """Executes (program, test) pairs, looking up the execution cache first."""
+        results = [None] * len(pairs)
+        if self.cache:
+            results = [self.cache.get(code, test) for code, test in pairs]
+        uncached = [i for i, result in enumerate(results) if result is None]
+        if len(uncached) > 0:
+            if self.sandbox:
+                executed = self.run_sources([pairs[i][0] + '\n' + pairs[i][1] for i in uncached])
+            else:
+                # 同じテストのプログラムはまとめて code_eval に渡す
+                groups = {}
+                for i in uncached:
+                    groups.setdefault(pairs[i][1], []).append(i)
+                executed_by_index = {}
+                for test, indices in groups.items():
+                    for i, result in zip(indices, self.run_programs([pairs[i][0] for i in indices], test)):
+                        executed_by_index[i] = result
+                executed = [executed_by_index[i] for i in uncached]
+            for i, result in zip(uncached, executed):
+                results[i] = {'passed': result['passed'], 'result': result['result']}
+                if self.cache:
+                    self.cache.put(pairs[i][0], pairs[i][1], results[i])
+        if self.cache:
+            self.cache.commit()
+        return results
+
+    def execute(self, programs: list, test: str) -> list:
+        return self.execute_pairs([(code, test) for code in programs])
+
+    def generate_programs(self, record) -> list:
         extracted_code = [humaneval_extract(record['model_input'], x) for x in record['extracted_results']]
-        record['generated_code'] = extracted_code
-        candidates = [extracted_code]
-        pass_at_k, results = self.eval.compute(references=test_cases, predictions=candidates, k=[1])
-        record['code_eval_results'] = results
-        record[self.metric_id] = pass_at_k['pass@1']
+        if not self.compact:
+            # コンパクト形式では model_input と extracted_results から再構成できるので保存しない
+            record['generated_code'] = extracted_code
+        return extracted_code
+
+    def store_results(self, record, results: list):
+        # code_eval と同じ形式 {task_id: [[completion_id, result], ...]}
+        record['code_eval_results'] = {0: [[i, dict(task_id=0, completion_id=i, **result)] for i, result in enumerate(results)]}
+        num_correct = sum(1 for result in results if result['passed'])
+        record[self.metric_id] = estimate_pass_at_k(len(results), num_correct, self.k)
+
+    def score_item(self, record):
+        results = self.execute(self.generate_programs(record), record['reference'])
+        self.store_results(record, results)
+
+    def score_batches(self, records):
+        """Executes the programs of several records at once so that all sandbox workers are kept busy."""
+        pending = [record for record in records if self.metric_id not in record]
+        batch_size = self.sandbox.batch_size
+        for start in tqdm(range(0, len(pending), batch_size), desc=f'{self.metric_id} (sandbox)'):
+            batch = pending[start:start+batch_size]
+            programs_list = [self.generate_programs(record) for record in batch]
+            pairs = [(code, record['reference']) for record, programs in zip(batch, programs_list) for code in programs]
+            results = self.execute_pairs(pairs)
+            offset = 0
+            for record, programs in zip(batch, programs_list):
+                self.store_results(record, results[offset:offset+len(programs)])
+                stamp_metric(record, self)
+                offset += len(programs)
+
+    def score(self, records):
+        if self.sandbox and not profiling_enabled():
+            # プロファイル時はレコードごとに計測するため、まとめて実行しない
+            self.score_batches(records)
+        results = super().score(records)
+        if self.cache:
+            self.args.verbose_print(f'実行キャッシュ//Execution cache hits={self.cache.hits} misses={self.cache.misses}')
+        if self.sandbox:
+            self.args.verbose_print(f'サンドボックス//Sandbox {self.sandbox.stats()}')
+        return results
+
+class ExecutionEvaluator(CodeEvalEvaluator):
+    """
+    C++/JavaScript のコードを実行して pass@k を算出するEvaluatorクラス
+    コンパイル結果はソースのハッシュでキャッシュし、実行はサンドボックスで行う。
+    """
+
+    def __init__(self, metric_id:str, args:dict, language:str):
+        # 実行キャッシュのキーに使うので、言語とコンパイラは先に設定する
+        self.language = language
+        self.compiler = CompileCache.from_args(language, args)
+        super().__init__(metric_id, args, sandbox=True)
+
+    def execution_context(self) -> dict:
+        return dict(super().execution_context(), compiler=self.compiler.settings())
+
+    def fingerprint(self):
+        return f'{super().fingerprint()}/{self.language}'
+
+    def generate_programs(self, record) -> list:
+        extracted_code = [multiple_extract(record['model_input'], x, self.language, record['reference']) for x in record['extracted_results']]
+        if not self.compact:
+            record['generated_code'] = extracted_code
+        return extracted_code
+
+    def run_sources(self, sources: list) -> list:
+        return self.compiler.run(self.sandbox, sources)
+
+    def score(self, records):
+        results = super().score(records)
+        self.args.verbose_print(f'コンパイル//Compile [{self.language}] {self.compiler.stats()}')
+        return results
+
+# 完全一致・正規化一致
+# evaluate を使わずに、事前にコンパイルした正規化関数でまとめて計算する
+
+_whitespace_pattern = re.compile(r'\s+')
+_punctuation_table = str.maketrans('', '', string.punctuation + '、。，．・「」『』（）！？：；')
+_number_pattern = re.compile(r'^[+-]?(\d{1,3}(,\d{3})+|\d+)(\.\d+)?$')
+CHOICE_LABELS = 'A,B,C,D,E,0,1,2,3,4,5,6,7,8,9'
+
+def normalize_number(text: str) -> str:
+    if _number_pattern.match(text):
+        value = float(text.replace(',', ''))
+        return str(int(value)) if value.is_integer() else str(value)
+    return text
+
+def compile_choice_parser(labels=CHOICE_LABELS):
+    """
+    Returns a function that parses a multiple-choice label such as '3', '(3)' or 'B' from the output.
+    Only the offered labels are recognized; "answer is X" is preferred, otherwise the last label is taken.
+    """
+    if isinstance(labels, str):
+        labels = [label.strip() for label in labels.split(',') if label.strip()]
+    alternatives = '|'.join(re.escape(label) for label in sorted(labels, key=len, reverse=True))
+    label = rf'(?<![A-Za-z0-9])({alternatives})(?![A-Za-z0-9])'
+    answer_pattern = re.compile(rf'(?:answer|答え|正解|解答)\s*(?:is|は|:|：)?\s*[\(\[（「]?\s*{label}', re.IGNORECASE)
+    label_pattern = re.compile(label)
+    upper_labels = {label.upper(): label for label in labels}
+
+    def parse_choice(text: str) -> str:
+        matches = answer_pattern.findall(text)
+        if matches:
+            return upper_labels.get(matches[-1].upper(), matches[-1])
+        matches = label_pattern.findall(text)
+        return matches[-1] if matches else text
+    return parse_choice
+
+def compile_normalizer(ignore_case=False, ignore_whitespace=False, ignore_punctuation=False,
+                       numeric=False, choice=False, strip=False, choice_labels=CHOICE_LABELS, extracted=False):
+    steps = [str.strip] if strip else []
+    if choice:
+        steps.append(compile_choice_parser(choice_labels))
+    if numeric:
+        steps.append(normalize_number)
+    if ignore_case:
+        steps.append(str.casefold)
+    if ignore_punctuation:
+        steps.append(lambda text: text.translate(_punctuation_table))
+    if ignore_whitespace:
+        steps.append(lambda text: _whitespace_pattern.sub('', text))
+
+    def normalize(text):
+        text = str(text)
+        for step in steps:
+            text = step(text)
+        return text
+    return normalize
 
 class ExactMatchEvaluator(Evaluator):
+    """
+    完全一致 (exact_match) と正規化一致 (normalized_match, choice_match) のEvaluatorクラス
+    exact_match は従来どおり model_output をそのまま比較する (match_strip, match_extracted で変更できる)。
+    """
+
+    def __init__(self, metric_id:str, args:dict, **defaults):
+        super().__init__(metric_id, args)
+        self.options = dict(
+            ignore_case=args[f'match_ignore_case|={defaults.get("ignore_case", False)}'],
+            ignore_whitespace=args[f'match_ignore_whitespace|={defaults.get("ignore_whitespace", False)}'],
+            ignore_punctuation=args[f'match_ignore_punctuation|={defaults.get("ignore_punctuation", False)}'],
+            numeric=args[f'match_numeric|={defaults.get("numeric", False)}'],
+            choice=args[f'match_choice|={defaults.get("choice", False)}'],
+            strip=args[f'match_strip|={defaults.get("strip", False)}'],
+            extracted=args[f'match_extracted|={defaults.get("extracted", False)}'],
+        )
+        if self.options['choice']:
+            self.options['choice_labels'] = args[f'match_choice_labels|={CHOICE_LABELS}']
+        self.normalize = compile_normalizer(**self.options)
+
+    def fingerprint(self):
+        options = ','.join(key if value is True else f'{key}={value}' for key, value in sorted(self.options.items()) if value)
+        return f'{super().fingerprint()}/{options}'
 
     def score_item(self, data):
-        predictions = [data['model_output']]
-        references = [data['reference']]
-        data['exact_match'] = self.eval.compute(predictions=predictions, references=references)['exact_match']
+        if self.options['extracted']:
+            prediction = data.get('extracted_result', data.get('model_output', ''))
+        else:
+            prediction = data.get('model_output', '')
+        data[self.metric_id] = float(self.normalize(prediction) == self.normalize(data['reference']))
+
+    def score(self, records):
+        score = 0.0
+        for record in records:
+            self.evaluate_record(record)
+            score += record[self.metric_id]
+        self.args.verbose_print(f'[{self.metric_id}] {score/max(len(records), 1):.3f} ({len(records)} items)')
+        return {self.metric_id: score}
     
 
 # 日本語用のtokenizer
@@ -161,13 +510,22 @@ class F1Evaluator(Evaluator):
 #######################
 
 def load_evaluator(metric_id, args):
+    language = args['output_lang|=py']
+    if metric_id in ("pass@1", "pass@k") and language in EXECUTABLE_LANGUAGES:
+        k = 1 if metric_id == "pass@1" else args['pass_at_k|k|=1']
+        return ExecutionEvaluator(f"pass@{k}", args, language)
     if metric_id == "pass@1":
         return CodeEvalEvaluator("pass@1", args, load_path='code_eval')
     elif metric_id == "pass@k":
         k = args['pass_at_k|k|=1']
         return CodeEvalEvaluator(f"pass@{k}", args, load_path='code_eval')
     elif metric_id == "exact_match":
-        return ExactMatchEvaluator("exact_match", args, load_path='exact_match')
+        return ExactMatchEvaluator("exact_match", args)
+    elif metric_id == "normalized_match":
+        return ExactMatchEvaluator("normalized_match", args, strip=True, extracted=True, ignore_case=True, ignore_whitespace=True,
+                                   ignore_punctuation=True, numeric=True)
+    elif metric_id == "choice_match":
+        return ExactMatchEvaluator("choice_match", args, strip=True, extracted=True, choice=True, ignore_case=True)
     else:
         print(f"未定義の評価尺度//Unknown metrics: {metric_id}")
     
@@ -1,63 +1,205 @@
-from typing import List
-import json
 import os
 import time
+import random
 from tqdm import tqdm
-from models import load_model
+from models import load_model, derive_seed
 from dataloaders import load_evaldata
 from templates import load_template
 from evaluators import compose_evaluators
+from records import new_records, load_records, save_records, incomplete_records, CheckpointWriter
+from stages import render_records, extract_records, budget_prompts, encode_prompts, schedule_records, dedup_prompts, fan_out, invalidate_stale, stamp_outputs, output_stop_sequences
+from shards import WorkQueue, shard_range, shard_dir, partial_path, merge_shards
+from sequential import SequentialEstimator
+from budgets import BudgetController
+from profiling import enable_profiling, profile_stage, save_profile
 from adhoc import adhoc_argument_parser
 
 
-def guess_uniquekey(dataset: List[dict]):
-    for key in dataset[0].keys():
-        if 'id' in key.lower():
-            return key
-    return None
+def run_inference(model, template, dataset, records, result_path, args, n=1, compact=False, indices=None, budget=None, writer=None):
+    num_workers = args['num_workers|=1']
+    chunk_size = args['chunk_size|=1000']
+    # 逐次評価のバッチ (indices の指定) ではプロンプト長などの集計を表示しない
+    verbose = indices is None
+    stop_sequences = output_stop_sequences(template, model)
+    render_records(records, dataset, template, indices=indices, num_workers=num_workers, chunk_size=chunk_size)
+    budget_prompts(records, model, args, n=n, indices=indices, verbose=verbose, stop_sequences=stop_sequences)
+    encode_prompts(records, model, args, indices=indices)
+    incomplete = incomplete_records(records, indices=indices)
+    pending = sorted(set(incomplete['inference']) | set(incomplete['extraction']))
+    if indices is None and len(pending) < len(records):
+        args.verbose_print(f'再開//Resume: 推論//inference {len(incomplete["inference"])} '
+                           f'抽出//extraction {len(incomplete["extraction"])} / {len(records)} records')
+    groups = dedup_prompts(records, model, args, n=n, indices=pending)
+    followers = {i for members in groups.values() for i in members}
+    order = schedule_records(records, model, args, n=n, indices=[i for i in pending if i not in followers], verbose=verbose)
+    if budget is None:
+        budget = BudgetController(model, args, n=n)
+    budget.start(records, order)
 
-def new_records(dataset):
-    keyid = guess_uniquekey(dataset)
-    if keyid:
-        return [{'unique_id': data[keyid]} for data in dataset]
-    else:
-        return [{'unique_id': f'index/{n}'} for n in range(len(dataset))]
-
-def load_records(result_path, dataset):
-    """Load existing results from the file."""
+    base_seed = args['seed']
+    targets = records if indices is None else [records[i] for i in indices]
+    elapsed_time = sum(record.get('inference_time', 0) for record in targets)
+    own_writer = writer is None
+    if own_writer:
+        # チェックポイントはバックグラウンドで保存し、推論を止めない
+        writer = CheckpointWriter(result_path, records, compact=compact, asynchronous=args['async_save|=true'])
     try:
-        with open(result_path, 'r', encoding='utf-8') as f:
-            return [json.loads(line) for line in f]
-    except FileNotFoundError:
-        return new_records(dataset)
+        changed = []
+        for step, i in enumerate(tqdm(order, desc=f'Inferencing {model}')):
+            record = records[i]
+            if 'model_outputs' not in record:
+                if not budget.allows(record):
+                    break
+                if base_seed is not None:
+                    record['seed'] = derive_seed(base_seed, record['unique_id'])
+                    record['generation_key'] = model.generation_key(record['model_input'], n=n, 
+                                                                    max_new_tokens=record.get('max_new_tokens'), 
+                                                                    seed=record['seed'])
+                start_time = time.time()
+                # トークン化済みのプロンプトがあれば、そのまま生成に使う
+                inputs = {}
+                if 'input_ids' in record and record.get('input_ids_key') == model.encoding_key(record['model_input']):
+                    inputs['input_ids'] = record['input_ids']
+                with profile_stage(record, 'inference'):
+                    record['model_outputs'] = model.generate_list(record['model_input'], n=n, 
+                                                                  max_new_tokens=record.get('max_new_tokens'),
+                                                                  seed=record.get('seed'), **inputs)
+                    record['model_output'] = record['model_outputs'][0]
+                stamp_outputs(record, n, stop_sequences)
+                record['inference_time'] = time.time() - start_time
+                if model.last_usage:
+                    record['usage'] = model.last_usage
+                budget.charge(record)
+                elapsed_time += record['inference_time']
+                changed.append(i)
+                if i in groups:
+                    fan_out(records, i, groups[i])
+                    changed.extend(groups[i])
+            if step % 10 == 9:
+                writer.update(records, changed)
+                changed = []
+        extract_records(records, template, indices=pending, num_workers=num_workers, chunk_size=chunk_size)
+        args['usage'] = budget.summary()
+        writer.update(records, indices)
+    finally:
+        if own_writer:
+            writer.close()
+    return elapsed_time
 
-def save_records(result_path, records, args=None):
-    directory = os.path.dirname(result_path)
-    if not os.path.exists(directory) and directory != '':
-        os.makedirs(directory)
+def run_evaluators(evaluators, records, result_path, compact=False, asynchronous=True):
+    results = {}
+    # 予算切れなどで推論していないレコードは評価しない
+    completed = [record for record in records if 'extracted_results' in record]
+    with CheckpointWriter(result_path, records, compact=compact, asynchronous=asynchronous) as writer:
+        for eval in evaluators:
+            results.update(eval.score(completed))
+            writer.update(records)
+    return results
 
-    with open(result_path, 'w', encoding='utf-8') as w:
-        for record in records:
-            print(json.dumps(record, ensure_ascii=False), file=w)
+def run_sequential(model, template, dataset, records, result_path, evaluators, args, n=1, compact=False):
+    """Evaluates records in random order and stops once the estimate is precise (or significant) enough."""
+    metric_ids = [eval.metric_id for eval in evaluators]
+    if len(metric_ids) == 0:
+        raise ValueError('sequential_eval requires an evaluator (specify --metrics)')
+    metric_id = args['sequential_metric'] or metric_ids[0]
+    if metric_id not in metric_ids:
+        raise ValueError(f'sequential_metric {metric_id} is not one of the evaluators: {metric_ids}')
+    baseline_path = args['baseline_result']
+    if baseline_path and not os.path.exists(baseline_path):
+        raise FileNotFoundError(f'The baseline result {baseline_path} does not exist.')
+    baseline_records = load_records(baseline_path, None) if baseline_path else None
+    estimator = SequentialEstimator(metric_id, args, len(records), baseline_records)
+    order = list(range(len(records)))
+    random.Random(args['seed|=0']).shuffle(order)
+    batch_size = args['sequential_batch|=10']
+    budget = BudgetController(model, args, n=n)
+    # プロンプト長と予算の見積もりは、全レコードについて最初に1回だけ表示する
+    render_records(records, dataset, template, num_workers=args['num_workers|=1'], chunk_size=args['chunk_size|=1000'])
+    budget_prompts(records, model, args, n=n, stop_sequences=output_stop_sequences(template, model))
+    budget.start(records, order)
+    with CheckpointWriter(result_path, records, compact=compact, asynchronous=args['async_save|=true']) as writer:
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            run_inference(model, template, dataset, records, result_path, args, n=n, compact=compact, 
+                          indices=batch, budget=budget, writer=writer)
+            for i in batch:
+                if 'extracted_results' not in records[i]:
+                    continue
+                for eval in evaluators:
+                    eval.evaluate_record(records[i])
+                estimator.update(records[i])
+            writer.update(records, batch)
+            if estimator.should_stop() or budget.exhausted:
+                break
+    # 結果ファイルと _config.json は呼び出し側 (main) でまとめて保存する
+    report = estimator.report()
+    args.verbose_print(f"逐次評価//Sequential: {metric_id}={report['mean']:.3f} "
+                       f"[{report['ci_lower']:.3f}, {report['ci_upper']:.3f}] "
+                       f"{report['records']}/{len(records)} records ({report['fraction']:.1%}) {report['stop_reason']}")
+    return report
 
-    if args:
-        savefile = result_path.replace('.jsonl', '_config.json')
-        args.save_as_json(savefile)
+def run_shards(model, template, dataset, records, result_path, evaluators, args, n=1, compact=False):
+    """Processes only the records assigned to this worker and saves them as partial result files."""
+    shard_queue = args['shard_queue']
+    if shard_queue:
+        queue = WorkQueue(shard_queue, len(records), 
+                          shard_size=args['shard_size|=1000'], 
+                          lease_ttl=args['shard_lease|=600'])
+        budget = BudgetController(model, args, n=n)
+        claimed = queue.claim()
+        while claimed:
+            start, end = claimed
+            args.verbose_print(f'シャード//Shard [{start}, {end}) 残り//remaining {queue.remaining()} ranges')
+            heartbeat = queue.heartbeat(start, end)
+            path = partial_path(result_path, start, end)
+            run_inference(model, template, dataset[start:end], records[start:end], path, args, n=n, compact=compact, budget=budget)
+            run_evaluators(evaluators, records[start:end], path, compact=compact, asynchronous=args['async_save|=true'])
+            save_records(path, records[start:end], compact=compact)
+            heartbeat.set()
+            if budget.exhausted:
+                break  # 範囲を完了にせず、lease の期限切れ後に他のワーカーが引き継ぐ
+            if queue.owns(start, end):
+                queue.complete(start, end)
+            else:
+                args.utils_print(f'他のワーカーが引き継いだ範囲です//Shard [{start}, {end}) was taken over by another worker')
+            claimed = queue.claim()
+    else:
+        start, end = shard_range(len(records), args['shard_index|=0'], args['num_shards'])
+        args.verbose_print(f'シャード//Shard [{start}, {end})')
+        path = partial_path(result_path, start, end)
+        run_inference(model, template, dataset[start:end], records[start:end], path, args, n=n, compact=compact)
+        run_evaluators(evaluators, records[start:end], path, compact=compact, asynchronous=args['async_save|=true'])
+        save_records(path, records[start:end], compact=compact)
 
 def main():
     args = adhoc_argument_parser(expand_config='config')
+    if args['profile|=false']:
+        enable_profiling(args)
 
     dataset = load_evaldata(args)
 
     template = load_template(args, dataset)
 
     result_path = args['result_path|record_path']
-    if result_path and args['resume|=false']:
-        records = load_records(result_path, dataset)
+    compact = args['compact_records|=false']
+    n = args['num_return_sequences|n|N|=1']
+    evaluators = compose_evaluators(args)
+    if result_path and args['merge_shards|=false']:
+        records = merge_shards(result_path)
+        args.verbose_print(f'シャードを結合しました//Merged {len(records)} records from {shard_dir(result_path)}')
+        model = None
     else:
-        records = new_records(dataset) 
+        model = load_model(args)
+        model.set_stop_sequences(template.stop_sequences)
+        if result_path and args['resume|=false']:
+            records = load_records(result_path, dataset)
+            invalidated = invalidate_stale(records, template, evaluators, n=n, 
+                                           stop_sequences=output_stop_sequences(template, model))
+            if invalidated:
+                args.verbose_print(f'再計算//Invalidated stages: {invalidated}')
+        else:
+            records = new_records(dataset) 
 
-    model = load_model(args)
     if model:
         test_run = args['test_run|=false']
         if result_path is None:
@@ -66,52 +208,45 @@ def main():
             result_path = f'{dataset_id}_{model_id}.jsonl'
             args.verbose_print(f'保存先//Saving.. {result_path}')
         
-        n = args['num_return_sequences|n|N|=1']
         args.verbose_print(f"モデル評価//Text-generation: {model} n={n}")
 
+        if args['shard_queue'] or args['num_shards']:
+            run_shards(model, template, dataset, records, result_path, evaluators, args, n=n, compact=compact)
+            args.utils_check()
+            return
+
+        if args['sequential_eval|=false']:
+            report = run_sequential(model, template, dataset, records, result_path, evaluators, args, n=n, compact=compact)
+            args['score'] = {'dataset': args['_dataset_id'], 'model': str(model), 'sequential': report}
+            save_records(result_path, records, args, compact=compact)
+            save_profile(result_path, records)
+            args.utils_check()
+            return
+
         if test_run:
             args.verbose_print('テスト実行のため先頭5件のみ実行します')
             result_path = result_path.replace('.json', '_test_run.json')
             records = records[:5]
         
-        elapsed_time = 0
-        for i, record in enumerate(tqdm(records, desc=f'Inferencing {model}')):
-            source = dataset[i]
-            if 'model_input' not in record:
-                record['model_input'] = template.create_prompt(source)
-            if 'reference' not in record:
-                record['reference'] = template.create_reference(source)
-            if 'model_outputs' not in record:
-                start_time = time.time()
-                record['model_outputs'] = model.generate_list(record['model_input'], n=n)
-                record['model_output'] = record['model_outputs'][0]
-                record['inference_time'] = time.time() - start_time
-            if 'inference_time' in record:
-                elapsed_time += record['inference_time']
-            if 'extracted_results' not in record:
-                record['extracted_results'] = template.extract(record['model_outputs'])
-                record['extracted_result'] = record['extracted_results'][0]
-            if i % 10 == 9:
-                save_records(result_path, records)
+        elapsed_time = run_inference(model, template, dataset, records, result_path, args, n=n, compact=compact)
         args.verbose_print(f'総推論時間//Total inference time {elapsed_time:.1f}s スループット {elapsed_time/(len(dataset)*n):.3f}s')
         args['total_inference_time'] = elapsed_time
         args['throughput'] = elapsed_time/(len(dataset)*n)
-        save_records(result_path, records)
         
-    evaluators = compose_evaluators(args)
     if len(evaluators) > 0 and result_path:
         args.verbose_print(f"評価尺度//Metrics: {evaluators}")
-        results = {}
-        for eval in evaluators:
-            results.update(eval.score(records))
-            save_records(result_path, records)
+        incomplete = incomplete_records(records, [eval.metric_id for eval in evaluators])
+        remaining = ' '.join(f'{eval.metric_id}={len(incomplete[eval.metric_id])}' for eval in evaluators)
+        args.verbose_print(f'未評価//Remaining: {remaining} / {len(records)} records')
+        results = run_evaluators(evaluators, records, result_path, compact=compact, asynchronous=args['async_save|=true'])
         print(f"スコア//Scores: {results}")
-        scores = {'dataset': args['_dataset_id'], 'model': str(model)}
+        scores = {'dataset': args['_dataset_id'], 'model': str(model or args['model_path|=dummy/model'])}
         scores.update(results)
         args['score'] = scores
 
     if result_path:
-        save_records(result_path, records, args)
+        save_records(result_path, records, args, compact=compact)
+        save_profile(result_path, records)
     
     args.utils_check()
 
@@ -1,8 +1,12 @@
 from typing import List
 import os, sys
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, set_seed
 import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
 from adhoc import AdhocArguments
 
 try:
@@ -12,6 +16,13 @@ except ModuleNotFoundError:
     ## OpenAIを実行するまでエラーを出さない
     OpenAI = None
 
+try:
+    import tiktoken
+except ModuleNotFoundError:
+    ## モジュールが見つからない場合は、
+    ## トークン数をバイト数から概算する
+    tiktoken = None
+
 try:
     import boto3
 except ModuleNotFoundError:
@@ -21,6 +32,26 @@ except ModuleNotFoundError:
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+def derive_seed(base_seed, unique_id, index=0) -> int:
+    """Derives a deterministic 31-bit seed from the base seed, unique_id and sample index."""
+    digest = hashlib.sha256(f'{base_seed}/{unique_id}/{index}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') & 0x7fffffff
+
+def find_stop(text: str, stop_sequences: List[str], start=0) -> int:
+    """Returns the position of the first stop sequence in text[start:] (-1 if not found)."""
+    found = -1
+    for stop in stop_sequences:
+        index = text.find(stop, start)
+        if index != -1 and (found == -1 or index < found):
+            found = index
+    return found
+
+def cut_at_stop(text: str, stop_sequences: List[str]) -> str:
+    if text is None:
+        return text
+    index = find_stop(text, stop_sequences)
+    return text if index == -1 else text[:index]
+
 # =====================
 # Base Classes
 # =====================
@@ -33,16 +64,64 @@ class Model(object):
         self.model_path = model_path
         self.args = args
         self.num_sequences = self.args['num_return_sequences|n|N|=1']
+        self.context_length = None
+        self.last_usage = None  # 直前の generate_list の呼び出しごとのレイテンシとトークン数
+        self.stop_sequences = []
+        self.prompt_per_sample = True  # n 個のサンプルごとにプロンプトが課金されるか
+        self.token_counts = {}  # プロンプトごとのトークン数 (同じプロンプトを何度もトークン化しない)
 
     def __repr__(self):
         return self.model_path
+
+    def sampling_config(self) -> dict:
+        """Returns the generation parameters that affect the outputs."""
+        return getattr(self, 'model_args', {})
+
+    def set_stop_sequences(self, stop_sequences: List[str]):
+        """
+        Sets the stop sequences; the output is cut before the first stop sequence.
+        Only models that cut their outputs (OpenAI, Bedrock) keep them.
+        """
+        pass
+
+    def generation_key(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> str:
+        """Returns a reproducible cache key of a generation request."""
+        request = [str(self), self.sampling_config(), prompt, n, max_new_tokens, seed]
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
     
-    def generate_list(self, prompt: str, n=1) -> List[str]:
+    def estimate_tokens(self, prompts: List[str]) -> List[int]:
+        """Roughly estimates the number of tokens (about 4 bytes per token)."""
+        return [(len(prompt.encode('utf-8')) + 3) // 4 for prompt in prompts]
+
+    def prompt_tokens(self, prompts: List[str]) -> List[int]:
+        """Returns the number of tokens the model actually reads for the prompts (including the prompt format)."""
+        return self.estimate_tokens(prompts)
+
+    def count_prompt_tokens(self, prompts: List[str]) -> List[int]:
+        """Returns prompt_tokens of the prompts, tokenizing each distinct prompt only once per run."""
+        missing = [prompt for prompt in set(prompts) if prompt not in self.token_counts]
+        if len(missing) > 0:
+            self.token_counts.update(zip(missing, self.prompt_tokens(missing)))
+        return [self.token_counts[prompt] for prompt in prompts]
+
+    def truncate_prompt(self, prompt: str, max_tokens: int) -> str:
+        """Keeps the last max_tokens (estimated) of the prompt."""
+        return prompt.encode('utf-8')[-max_tokens * 4:].decode('utf-8', errors='ignore')
+
+    def encoding_key(self, prompt: str):
+        """Identifies the token ids of the prompt that generate_list accepts as input_ids (None if unsupported)."""
+        return None
+
+    def encode_prompts(self, prompts: List[str]):
+        """Returns the token ids of the prompts to generate from (None if the model has no local tokenizer)."""
+        return None
+
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> List[str]:
         return [self.generate_text(prompt) for _ in range(n)]
 
 class TestModel(Model):
 
-    def generate_list(self, prompt: str, n=1) -> List[str]:
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> List[str]:
         test_results = [f"{prompt}\n###Output\n{i}\n" for i in range(n)]
         return test_results
 
@@ -58,18 +137,103 @@ class OpenAIModel(Model):
             "max_tokens": args['max_tokens|max_length|=512'], 
         }
         self.openai_api_key = args['openai_api_key|api_key|!error']
+        self.stream = args['openai_stream|stream|=true']
         self.model_args = default_args
+        self.prompt_per_sample = False  # n 個のサンプルをまとめて1回のリクエストで生成する
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model_path)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding('cl100k_base')
+
+    def estimate_tokens(self, prompts: List[str]) -> List[int]:
+        if self.encoding is None:
+            return super().estimate_tokens(prompts)
+        return [len(ids) for ids in self.encoding.encode_batch(prompts, disallowed_special=())]
 
-    def generate_list(self, prompt: str, n=1) -> List[str]:
+    def set_stop_sequences(self, stop_sequences: List[str]):
+        self.stop_sequences = list(stop_sequences)
+        if len(self.stop_sequences) > 0:
+            # API 側でも止める (OpenAI は最大4個まで)
+            self.model_args['stop'] = self.stop_sequences[:4]
+
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> List[str]:
         client = OpenAI(api_key=self.openai_api_key)
-        response = client.chat.completions.create(
+        model_args = dict(self.model_args)
+        if max_new_tokens:
+            model_args['max_tokens'] = max_new_tokens
+        if seed is not None:
+            model_args['seed'] = seed
+        start_time = time.time()
+        usage = {}
+        if self.stream:
+            responses = self.read_stream(client, prompt, n, model_args, usage)
+        else:
+            response = client.chat.completions.create(
+                model=self.model_path,
+                messages=[{"role": "user", "content": prompt}],
+                n=n,
+                **model_args
+            )
+            self.read_usage(response.usage, usage)
+            responses = [cut_at_stop(choice.message.content, self.stop_sequences) for choice in response.choices]
+        if 'input_tokens' not in usage:
+            # ストリームを途中で閉じた場合は usage が返らないので、手元で数える
+            usage['input_tokens'] = self.count_prompt_tokens([prompt])[0]
+            usage['output_tokens'] = sum(self.estimate_tokens(responses))
+            usage['estimated'] = True
+        usage['latency'] = time.time() - start_time
+        self.last_usage = [usage]
+        return responses
+
+    def read_usage(self, response_usage, usage: dict):
+        if response_usage is not None:
+            usage['input_tokens'] = response_usage.prompt_tokens
+            usage['output_tokens'] = response_usage.completion_tokens
+
+    def read_stream(self, client, prompt: str, n, model_args, usage: dict) -> List[str]:
+        """
+        Receives the outputs token by token and cancels the stream 
+        as soon as every output contains a stop sequence.
+        """
+        stream = client.chat.completions.create(
             model=self.model_path,
             messages=[{"role": "user", "content": prompt}],
             n=n,
-            **self.model_args
+            stream=True,
+            stream_options={"include_usage": True},
+            **model_args
         )
-        responses = [choice.message.content for choice in response.choices]
-        return responses
+        texts = [''] * n
+        stopped = [False] * n
+        cut = False  # 手元で停止文字列を見つけて打ち切ったか
+        max_stop = max((len(stop) for stop in self.stop_sequences), default=0)
+        try:
+            for chunk in stream:
+                self.read_usage(getattr(chunk, 'usage', None), usage)
+                for choice in chunk.choices:
+                    i = choice.index
+                    delta = choice.delta.content if choice.delta else None
+                    if stopped[i] or not delta:
+                        stopped[i] = stopped[i] or choice.finish_reason is not None
+                        continue
+                    # 前回までの末尾にまたがる停止文字列も見つけられるように少し戻って探す
+                    start = max(len(texts[i]) - max_stop + 1, 0)
+                    texts[i] += delta
+                    index = find_stop(texts[i], self.stop_sequences, start)
+                    if index != -1:
+                        texts[i] = texts[i][:index]
+                        stopped[i] = True
+                        cut = True
+                    elif choice.finish_reason is not None:
+                        stopped[i] = True
+                # すべて API 側で終わった場合は、最後に送られる usage を受け取る
+                if all(stopped) and cut:
+                    break
+        finally:
+            stream.close()  # 残りの生成を打ち切る
+        return texts
 
 class BedrockModel(Model):
     def __init__(self, model_path, args):
@@ -77,14 +241,25 @@ class BedrockModel(Model):
         if boto3 is None:
             args.raise_uninstalled_module('boto3')
 
+        # messages: Messages API, completion: 旧形式 (\n\nHuman: ... \n\nAssistant:)
+        self.api = args['bedrock_api|=messages']
+        self.stream = args['bedrock_stream|stream|=false']
+        self.max_concurrency = args['bedrock_concurrency|=8']
+        max_tokens_key = "max_tokens" if self.api == 'messages' else "max_tokens_to_sample"
         default_args = {
-            "max_tokens_to_sample": args['max_tokens|max_length|=512'],
+            max_tokens_key: args['max_tokens|max_length|=512'],
             "temperature": args['temperature|=0.2'],
             "top_p": args['top_p|=0.95'],
         }
         self.aws_access_key_id = args['aws_access_key_id']
         self.aws_secret_access_key = args['aws_secret_access_key']
         self.model_args = default_args
+        # boto3 のクライアントはスレッドセーフなので1つを使い回す
+        self.client = boto3.client("bedrock-runtime",
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                region_name=args['aws_region|region_name|=ap-northeast-1']
+        )
     
     def check_and_append_claude_format(self, prompt: str) -> str:
         ## FIXME: 改行の位置はここでいいのか？
@@ -99,24 +274,138 @@ class BedrockModel(Model):
 
         return prompt
 
-    def generate_text(self, prompt: str) -> str:
-        bedrock = boto3.client("bedrock-runtime",
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                region_name='ap-northeast-1'
-        )
-        prompt = self.check_and_append_claude_format(prompt)
-        body = json.dumps(
-            {
-                "prompt": prompt,
-                "anthropic_version": "bedrock-2023-05-31",
-                **self.model_args,
-            }
-        )
-        response = bedrock.invoke_model(body=body, modelId=self.model_path)
+    def set_stop_sequences(self, stop_sequences: List[str]):
+        self.stop_sequences = list(stop_sequences)
+        if len(self.stop_sequences) > 0:
+            self.model_args['stop_sequences'] = self.stop_sequences
+
+    def request_body(self, prompt: str, max_new_tokens=None) -> str:
+        model_args = dict(self.model_args)
+        if max_new_tokens:
+            model_args["max_tokens" if self.api == 'messages' else "max_tokens_to_sample"] = max_new_tokens
+        if self.api == 'messages':
+            body = {"messages": [{"role": "user", "content": prompt}]}
+        else:
+            body = {"prompt": self.check_and_append_claude_format(prompt)}
+        return json.dumps({**body, "anthropic_version": "bedrock-2023-05-31", **model_args})
+
+    def read_response(self, response, usage: dict) -> str:
         response_body = json.loads(response.get("body").read())
+        if self.api == 'messages':
+            usage['input_tokens'] = response_body.get('usage', {}).get('input_tokens')
+            usage['output_tokens'] = response_body.get('usage', {}).get('output_tokens')
+            return ''.join(block.get('text', '') for block in response_body.get('content', []))
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        usage['input_tokens'] = int(headers.get('x-amzn-bedrock-input-token-count', 0)) or None
+        usage['output_tokens'] = int(headers.get('x-amzn-bedrock-output-token-count', 0)) or None
         return response_body.get("completion")
 
+    def read_stream(self, response, usage: dict) -> str:
+        text = ''
+        max_stop = max((len(stop) for stop in self.stop_sequences), default=0)
+        stream = response.get("body")
+        for event in stream:
+            chunk = json.loads(event['chunk']['bytes'])
+            delta = ''
+            if chunk.get('type') == 'content_block_delta':
+                delta = chunk['delta'].get('text', '')
+            elif 'completion' in chunk:
+                delta = chunk['completion']
+            if delta and self.stop_sequences:
+                start = max(len(text) - max_stop + 1, 0)
+                text += delta
+                index = find_stop(text, self.stop_sequences, start)
+                if index != -1:
+                    # 停止文字列が出たらストリームを閉じて残りの生成を打ち切る
+                    # (出力トークン数が返らないので、停止文字列までの生成を手元で数える)
+                    usage['stopped'] = True
+                    usage['output_tokens'] = self.estimate_tokens([text])[0]
+                    usage['estimated'] = True
+                    if hasattr(stream, 'close'):
+                        stream.close()
+                    return text[:index]
+                continue
+            text += delta
+            if 'usage' in chunk.get('message', {}):
+                usage['input_tokens'] = chunk['message']['usage'].get('input_tokens')
+            if 'output_tokens' in chunk.get('usage', {}):
+                usage['output_tokens'] = chunk['usage']['output_tokens']
+            metrics = chunk.get('amazon-bedrock-invocationMetrics')
+            if metrics:
+                usage['input_tokens'] = metrics.get('inputTokenCount', usage.get('input_tokens'))
+                usage['output_tokens'] = metrics.get('outputTokenCount', usage.get('output_tokens'))
+        return text
+
+    def invoke(self, prompt: str, max_new_tokens=None):
+        """Invokes the model once and returns (text, usage with latency)."""
+        body = self.request_body(prompt, max_new_tokens)
+        usage = {}
+        start_time = time.time()
+        if self.stream:
+            response = self.client.invoke_model_with_response_stream(body=body, modelId=self.model_path)
+            text = self.read_stream(response, usage)
+        else:
+            response = self.client.invoke_model(body=body, modelId=self.model_path)
+            text = cut_at_stop(self.read_response(response, usage), self.stop_sequences)
+        usage['latency'] = time.time() - start_time
+        return text, usage
+
+    def generate_text(self, prompt: str) -> str:
+        return self.invoke(prompt)[0]
+
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> List[str]:
+        # Bedrock には n の指定がないので、n 回のリクエストを並行して送る
+        with ThreadPoolExecutor(max_workers=max(min(n, self.max_concurrency), 1)) as executor:
+            results = list(executor.map(lambda _: self.invoke(prompt, max_new_tokens), range(n)))
+        self.last_usage = [usage for _, usage in results]
+        return [text for text, _ in results]
+
+
+class RemoteModel(Model):
+    """
+    server.py で起動したモデルサーバに生成を依頼する (モデルを再ロードしない)
+    """
+    def __init__(self, server_url, args):
+        self.server_url = server_url.rstrip('/')
+        info = self.request('/info')
+        super().__init__(info['model'], args)
+        self.context_length = info.get('context_length')
+        # サーバ側の生成パラメータ (生成キーや重複除去のキーに含める)
+        self.remote_sampling_config = info.get('sampling_config')
+        if self.remote_sampling_config is None:
+            args.utils_print(f'サーバが生成パラメータを返しません//The model server does not report its sampling config: {self.server_url}')
+
+    def sampling_config(self) -> dict:
+        if self.remote_sampling_config is None:
+            # 古いサーバでは、少なくともサーバごとに区別する
+            return {'server': self.server_url}
+        return self.remote_sampling_config
+
+    def request(self, path, data=None):
+        if data is None:
+            request = urllib.request.Request(self.server_url + path)
+        else:
+            request = urllib.request.Request(self.server_url + path, 
+                                             data=json.dumps(data).encode('utf-8'), 
+                                             headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f'Model server error: {json.loads(e.read()).get("error")}')
+
+    def estimate_tokens(self, prompts: List[str]) -> List[int]:
+        return self.request('/estimate_tokens', {'prompts': prompts})['lengths']
+
+    def prompt_tokens(self, prompts: List[str]) -> List[int]:
+        return self.request('/prompt_tokens', {'prompts': prompts})['lengths']
+
+    def truncate_prompt(self, prompt: str, max_tokens: int) -> str:
+        return self.request('/truncate_prompt', {'prompt': prompt, 'max_tokens': max_tokens})['prompt']
+
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None) -> List[str]:
+        data = {'prompt': prompt, 'n': n, 'max_new_tokens': max_new_tokens, 'seed': seed}
+        return self.request('/generate', data)['outputs']
 
 class HFModel(Model):
     def __init__(self, model_path, args):
@@ -132,6 +421,13 @@ class HFModel(Model):
             model = load_4bit_model(model_path, args)
         else:
             model = load_normal_model(model_path, args)
+        self.model = model
+        self.context_length = getattr(model.config, 'max_position_embeddings', None)
+        # チャットモデルは tokenizer のチャットテンプレートでプロンプトを整形する
+        self.chat_template = args['chat_template|=false']
+        if self.chat_template and not getattr(self.tokenizer, 'chat_template', None):
+            args.utils_print(f'チャットテンプレートがありません//No chat template in the tokenizer: {model_path}')
+            self.chat_template = False
         
         if "max_new_tokens" in args:
             self.generator_args = {
@@ -161,16 +457,78 @@ class HFModel(Model):
             # **generator_args
         )
     
-    def generate_list(self, prompt: str, n=1) -> List[str]:
+    def sampling_config(self) -> dict:
+        return self.generator_args
+
+    def estimate_tokens(self, prompts: List[str]) -> List[int]:
+        if len(prompts) == 0:
+            return []
+        input_ids = self.tokenizer(prompts, add_special_tokens=False)['input_ids']
+        return [len(ids) for ids in input_ids]
+
+    def prompt_tokens(self, prompts: List[str]) -> List[int]:
+        if not self.chat_template:
+            return self.estimate_tokens(prompts)
+        # チャットテンプレートで整形したトークン列の長さを数える
+        return [len(ids) for ids in self.encode_prompts(prompts)]
+
+    def truncate_prompt(self, prompt: str, max_tokens: int) -> str:
+        input_ids = self.tokenizer(prompt, add_special_tokens=False)['input_ids']
+        if self.chat_template:
+            # チャットテンプレートの分を除いて、整形後に max_tokens に収まるようにする
+            overhead = self.prompt_tokens([prompt])[0] - len(input_ids)
+            max_tokens = max(max_tokens - overhead, 0)
+        return self.tokenizer.decode(input_ids[len(input_ids) - min(max_tokens, len(input_ids)):])
+
+    def encoding_key(self, prompt: str):
+        """Identifies the tokenizer, the prompt format and the prompt that produced cached input_ids."""
+        if not self.chat_template:
+            return None
+        return hashlib.sha256(f'{self.model_path}/chat={self.chat_template}/{prompt}'.encode('utf-8')).hexdigest()[:16]
+
+    def encode_prompts(self, prompts: List[str]):
+        if not self.chat_template:
+            return None
+        if len(prompts) == 0:
+            return []
+        texts = [self.tokenizer.apply_chat_template([{"role": "user", "content": prompt}], 
+                                                    tokenize=False, add_generation_prompt=True) for prompt in prompts]
+        # テンプレートに BOS などが含まれるので、特殊トークンは追加しない (fast tokenizer でまとめてトークン化する)
+        return self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+    def generate_ids(self, input_ids: List[int], n, generator_args) -> List[str]:
+        """Generates directly from cached token ids (without re-tokenizing the prompt)."""
+        generate_args = {k: v for k, v in generator_args.items() if k != 'return_full_text'}
+        ids = torch.tensor([input_ids], device=self.model.device)
+        outputs = self.model.generate(ids, 
+                                      attention_mask=torch.ones_like(ids),
+                                      num_return_sequences=n,
+                                      pad_token_id=self.tokenizer.eos_token_id,
+                                      **generate_args)
+        return self.tokenizer.batch_decode(outputs[:, len(input_ids):], skip_special_tokens=True)
+
+    def generate_list(self, prompt: str, n=1, max_new_tokens=None, seed=None, input_ids=None) -> List[str]:
         # pipelineなしで実装----------------------------------
         # input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(self.device)
         # generated_ids = self.model.generate(input_ids, **self.model_args)
         # return self.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
         # ----------------------------------
+        generator_args = self.generator_args
+        if max_new_tokens:
+            # プロンプト長に合わせた max_new_tokens を優先する
+            generator_args = {k: v for k, v in generator_args.items() if k != 'max_length'}
+            generator_args['max_new_tokens'] = max_new_tokens
+        if seed is not None:
+            set_seed(seed)
+        if input_ids is None and self.chat_template:
+            # キャッシュがない場合 (モデルサーバ経由など) も、チャットテンプレートで整形してから生成する
+            input_ids = self.encode_prompts([prompt])[0]
+        if input_ids is not None:
+            return self.generate_ids(input_ids, n, generator_args)
         generated_texts = self.generator(prompt, 
                                          ### ここは何を指定するのか？
                                         num_return_sequences = n,
-                                         **self.generator_args, 
+                                         **generator_args, 
                                          pad_token_id=self.generator.tokenizer.eos_token_id)
         generated_texts_list = [item['generated_text'] for item in generated_texts]
         return generated_texts_list
@@ -215,7 +573,9 @@ def load_4bit_model(model_path, args):
 def load_model(args):
     model_path = args['model_path']
     try:
-        if model_path is None:
+        if args['model_server']:
+            return RemoteModel(args['model_server'], args)
+        elif model_path is None:
             return TestModel('dummy/model', args)
         elif model_path.startswith("openai:"):
             return OpenAIModel(model_path[7:], args)
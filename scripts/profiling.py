@@ -0,0 +1,131 @@
+from typing import List
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from records import result_base
+
+try:
+    import pyinstrument
+except ModuleNotFoundError:
+    ## モジュールが見つからない場合は、
+    ## profile_tool pyinstrument を使うまでエラーを出さない
+    pyinstrument = None
+
+# =====================
+# Profiling
+# =====================
+#
+# --profile を指定すると、レコードごと・ステージごとに
+# 実時間 (wall), CPU時間 (cpu), ピークメモリ (peak_memory), 出力サイズ (output_size) を
+# レコードの _profile に記録し、遅いレコードの上位 profile_top_k 件を報告する。
+# --profile_stages inference,extract を指定すると、そのステージの cProfile (または pyinstrument) を保存する。
+
+class Profiler(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.top_k = args['profile_top_k|=10']
+        stages = args['profile_stages|=']
+        self.stages = [stage.strip() for stage in stages.split(',') if stage.strip()] if isinstance(stages, str) else list(stages)
+        self.tool = args['profile_tool|=cprofile']
+        if self.tool == 'pyinstrument' and pyinstrument is None:
+            args.raise_uninstalled_module('pyinstrument')
+        self.profilers = {}
+        self.totals = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage_profiler(self, stage):
+        if stage not in self.stages:
+            return None
+        if stage not in self.profilers:
+            if self.tool == 'pyinstrument':
+                self.profilers[stage] = pyinstrument.Profiler()
+            else:
+                self.profilers[stage] = cProfile.Profile()
+        return self.profilers[stage]
+
+    @contextmanager
+    def measure(self, record: dict, stage: str):
+        before = {key: id(value) for key, value in record.items()}
+        profiler = self.stage_profiler(stage)
+        tracemalloc.reset_peak()
+        base_memory = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profiler:
+            profiler.start() if self.tool == 'pyinstrument' else profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.stop() if self.tool == 'pyinstrument' else profiler.disable()
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            peak_memory = tracemalloc.get_traced_memory()[1] - base_memory
+            # ステージで追加・更新されたキーの JSON サイズを出力サイズとする
+            output_size = sum(len(json.dumps(value, ensure_ascii=False, default=str))
+                              for key, value in record.items()
+                              if key != '_profile' and before.get(key) != id(value))
+            profile = record.setdefault('_profile', {})
+            profile[stage] = {'wall': wall, 'cpu': cpu, 'peak_memory': peak_memory, 'output_size': output_size}
+            total = self.totals.setdefault(stage, {'records': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['records'] += 1
+            total['wall'] += wall
+            total['cpu'] += cpu
+
+    def report(self, records: List[dict]) -> dict:
+        """Returns the per-stage totals and the top-K slowest records."""
+        profiled = [record for record in records if '_profile' in record]
+        def total_wall(record):
+            return sum(stage['wall'] for stage in record['_profile'].values())
+        slowest = sorted(profiled, key=total_wall, reverse=True)[:self.top_k]
+        return {
+            'stages': self.totals,
+            'slowest': [{'unique_id': record['unique_id'], 'wall': total_wall(record),
+                         'stages': record['_profile']} for record in slowest],
+        }
+
+    def save(self, result_path, records: List[dict]):
+        base = result_base(result_path)
+        report = self.report(records)
+        with open(f'{base}_profile.json', 'w', encoding='utf-8') as w:
+            json.dump(report, w, ensure_ascii=False, indent=2)
+        for stage, profiler in self.profilers.items():
+            if self.tool == 'pyinstrument':
+                with open(f'{base}_{stage}.html', 'w', encoding='utf-8') as w:
+                    w.write(profiler.output_html())
+            else:
+                profiler.dump_stats(f'{base}_{stage}.prof')
+        summary = ' '.join(f'{stage}={total["wall"]:.2f}s' for stage, total in self.totals.items())
+        self.args.verbose_print(f'プロファイル//Profile: {summary} -> {base}_profile.json')
+        for item in report['slowest']:
+            stages = ' '.join(f'{stage}={values["wall"]:.3f}s' for stage, values in item['stages'].items())
+            self.args.verbose_print(f'  {item["unique_id"]} {item["wall"]:.3f}s ({stages})')
+        return report
+
+_profiler = None
+
+def enable_profiling(args):
+    global _profiler
+    _profiler = Profiler(args)
+    return _profiler
+
+def profiling_enabled():
+    return _profiler is not None
+
+@contextmanager
+def profile_stage(record: dict, stage: str):
+    """Measures the stage of the record when profiling is enabled (otherwise does nothing)."""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.measure(record, stage):
+            yield
+
+def save_profile(result_path, records: List[dict]):
+    if _profiler is not None and result_path:
+        return _profiler.save(result_path, records)
+    return None
@@ -0,0 +1,527 @@
+from typing import List
+import io
+import gzip
+import json
+import os
+import queue
+import atexit
+import signal
+import threading
+from collections import Counter
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    ## モジュールが見つからない場合は、
+    ## .zst ファイルを使うまでエラーを出さない
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    ## モジュールが見つからない場合は、
+    ## 列指向形式を使うまでエラーを出さない
+    pa = None
+
+# =====================
+# Result Records
+# =====================
+
+def guess_uniquekey(dataset: List[dict]):
+    for key in dataset[0].keys():
+        if 'id' in key.lower():
+            return key
+    return None
+
+def new_records(dataset):
+    if hasattr(dataset, 'unique_ids'):
+        # インデックスつきのデータセットは行を読まずに unique_id を得る
+        return [{'unique_id': unique_id} for unique_id in dataset.unique_ids()]
+    keyid = guess_uniquekey(dataset)
+    if keyid:
+        return [{'unique_id': data[keyid]} for data in dataset]
+    else:
+        return [{'unique_id': f'index/{n}'} for n in range(len(dataset))]
+
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+
+def compression_suffix(path: str):
+    for suffix in COMPRESSION_SUFFIXES:
+        if path.endswith(suffix):
+            return suffix
+    return ''
+
+def strip_compression(path: str):
+    suffix = compression_suffix(path)
+    return path[:-len(suffix)] if suffix else path
+
+def open_records(result_path, mode='r'):
+    """
+    Opens a result file as a text stream. Files ending with .gz/.zst are (de)compressed
+    while streaming, so neither reading nor writing holds the whole file in memory.
+    In append mode ('a') a new gzip member/zstd frame is added without recompressing the file.
+    """
+    if result_path.endswith('.gz'):
+        return gzip.open(result_path, mode + 't', encoding='utf-8')
+    if result_path.endswith('.zst'):
+        if zstandard is None:
+            raise ModuleNotFoundError('zstandard is required for .zst files (pip3 install -U zstandard)')
+        fh = open(result_path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True, closefd=True)
+        else:
+            # threads=-1: 利用可能なCPUコアで並列に圧縮する
+            stream = zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(fh, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(result_path, mode, encoding='utf-8')
+
+RESULT_SUFFIXES = ('.jsonl', '.parquet', '.arrow')
+
+def result_base(result_path):
+    """Returns the result path without its suffix (.jsonl, .jsonl.gz, .jsonl.zst, .parquet, .arrow)."""
+    path = strip_compression(result_path)
+    for suffix in RESULT_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+def config_path(result_path):
+    """Returns the path of the config file saved next to the result file."""
+    return result_base(result_path) + '_config.json'
+
+# 圧縮ファイルの末尾のメンバー/フレームが途中で切れている場合のエラー
+_TRUNCATED_ERRORS = (EOFError, OSError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def read_lines(result_path) -> List[dict]:
+    """
+    Reads the records of a result file. Lines with _row (appended by incremental checkpoints)
+    replace the record at that position. A checkpoint cut off by a crash is ignored.
+    """
+    records = []
+    with open_records(result_path, 'r') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f'🐥 途中で切れた行を読み飛ばします//Skipped a truncated line in {result_path}')
+                    continue
+                row = record.pop('_row', None)
+                if row is None:
+                    records.append(expand_record(record))
+                elif row < len(records):
+                    records[row] = expand_record(record)
+        except _TRUNCATED_ERRORS:
+            print(f'🐥 途中で切れたチェックポイントを読み飛ばします//Skipped a truncated checkpoint in {result_path}')
+    return records
+
+def load_records(result_path, dataset):
+    """Load existing results from the file (aligned to the dataset by unique_id)."""
+    if is_columnar(result_path) and os.path.exists(result_path):
+        records = load_columnar(result_path)
+    else:
+        try:
+            records = read_lines(result_path)
+        except FileNotFoundError:
+            return new_records(dataset)
+    if dataset is None:
+        return records
+    return align_records(records, dataset)
+
+def align_records(saved_records: List[dict], dataset):
+    """
+    保存済みのレコードを unique_id でデータセットの順序に合わせる
+    データセットの順序が変わっても、途中までの結果ファイルでも正しく再開できる。
+    """
+    records = new_records(dataset)
+    resume_index = {record['unique_id']: record for record in saved_records}
+    if len(resume_index) < len(saved_records) or len(records) != len({r['unique_id'] for r in records}):
+        print('🐥 unique_id が重複しているため、位置で対応づけます//Duplicated unique_id, aligned by position')
+        return saved_records + records[len(saved_records):]
+    return [resume_index.get(record['unique_id'], record) for record in records]
+
+def incomplete_records(records: List[dict], metric_ids=(), indices=None) -> dict:
+    """Returns the indices of records whose inference, extraction or metrics are not yet done."""
+    incomplete = {'inference': [], 'extraction': []}
+    incomplete.update({metric_id: [] for metric_id in metric_ids})
+    for i in range(len(records)) if indices is None else indices:
+        record = records[i]
+        if 'model_outputs' not in record:
+            incomplete['inference'].append(i)
+        if 'extracted_results' not in record:
+            incomplete['extraction'].append(i)
+        for metric_id in metric_ids:
+            if metric_id not in record:
+                incomplete[metric_id].append(i)
+    return incomplete
+
+def write_atomic(result_path, lines):
+    """Writes lines to a temporary file, fsyncs it and renames it to the result file."""
+    directory = os.path.dirname(result_path)
+    if not os.path.exists(directory) and directory != '':
+        os.makedirs(directory)
+    # 拡張子 (.gz/.zst) を保ったまま一時ファイルに書き込む
+    tmp_path = os.path.join(directory, f'.tmp-{os.getpid()}-{os.path.basename(result_path)}')
+    with open_records(tmp_path, 'w') as w:
+        for line in lines:
+            w.write(line)
+            w.write('\n')
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, result_path)
+
+def dump_record(record: dict, compact=False) -> str:
+    if compact:
+        record = compact_record(record)
+    return json.dumps(record, ensure_ascii=False)
+
+def save_records(result_path, records, args=None, compact=False):
+    if is_columnar(result_path):
+        # 結果ファイル自体が Parquet/Arrow の場合はその形式で保存する
+        save_columnar(result_path, records, args)
+    else:
+        write_atomic(result_path, (dump_record(record, compact) for record in records))
+
+    if args:
+        result_format = args['result_format']
+        if result_format and not is_columnar(result_path):
+            save_columnar(columnar_path(result_path, result_format), records, args)
+        savefile = config_path(result_path)
+        args.save_as_json(savefile)
+
+def _snapshot(record: dict) -> dict:
+    # 書き込み中に変更されてもよいように、入れ子の辞書 (_fingerprints など) もコピーする
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in record.items()}
+
+class CheckpointWriter(object):
+    """
+    推論・評価中のチェックポイントをバックグラウンドのスレッドで保存する
+    変更されたレコードのスナップショットだけをキューで受け取り、JSON の行をレコードごとにキャッシュして、
+    一時ファイルに書き込んでから rename する。溜まった更新はまとめて1回で書き込む。
+    圧縮ファイル (.gz/.zst) では、2回目以降は変更されたレコードだけを位置 (_row) つきで
+    新しい gzip メンバー/zstd フレームとして追記し、ファイル全体を圧縮し直さない。
+    追記した行がレコード数を超えたときと終了時には、ファイル全体を書き直して追記分をまとめる。
+    終了時 (with ブロックの終了, atexit, SIGTERM) に残りを書き込む。
+    """
+
+    def __init__(self, result_path, records, compact=False, asynchronous=True):
+        self.result_path = result_path
+        self.compact = compact
+        # Parquet/Arrow の結果ファイルは行をキャッシュできないので、スナップショットを保持して書き込む
+        self.columnar = is_columnar(result_path)
+        self.incremental = compression_suffix(result_path) != '' and not self.columnar
+        self.dirty = set()  # 最後の書き込みから変更されたレコード
+        self.appended = None  # 最後に全体を書き込んでから追記した行数 (None はまだ全体を書き込んでいない)
+        self.lines = [None] * len(records)
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.critical = False  # キューを操作中 (SIGTERM を遅らせる)
+        self.deferred_signal = None
+        self.previous_handler = None
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True) if asynchronous else None
+        # 最初に全レコードを渡しておき、以降は変更されたレコードだけを受け取る
+        self.update(records, write=False)
+        if asynchronous:
+            self.thread.start()
+            atexit.register(self.close)
+            self._install_signal_handler()
+
+    def _install_signal_handler(self):
+        self.previous_handler = None
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self.previous_handler = signal.getsignal(signal.SIGTERM)
+        def handle_sigterm(signum, frame):
+            # シグナルハンドラの中では close() を呼ばない (割り込んだ queue.put のロックを待って止まる)
+            # SystemExit を送出して、with ブロックや finally の close() で書き込ませる
+            # キューのロックを持っている間に送出するとロックが解放されないので、抜けるまで遅らせる
+            if self.critical:
+                self.deferred_signal = signum
+                return
+            self._terminate(signum, self.previous_handler, frame)
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    @staticmethod
+    def _terminate(signum, previous_handler, frame=None):
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        raise SystemExit(128 + signum)
+
+    def _raise_deferred(self, previous_handler):
+        signum = self.deferred_signal
+        if signum is not None:
+            self.deferred_signal = None
+            self._terminate(signum, previous_handler)
+
+    def _restore_signal_handler(self):
+        if self.previous_handler is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.previous_handler)
+            self.previous_handler = None
+
+    def update(self, records, indices=None, write=True):
+        """Queues snapshots of the changed records (all records if indices is None)."""
+        if self.error:
+            raise self.error
+        if indices is None:
+            indices = range(len(records))
+        changes = [(i, _snapshot(records[i])) for i in indices]
+        if self.thread is None:
+            self.apply(changes)
+            if write:
+                self.write()
+        else:
+            self.critical = True
+            try:
+                self.queue.put((changes, write))
+            finally:
+                self.critical = False
+            self._raise_deferred(self.previous_handler)
+
+    def apply(self, changes):
+        for i, record in changes:
+            self.lines[i] = record if self.columnar else dump_record(record, self.compact)
+            self.dirty.add(i)
+
+    def write(self, final=False):
+        if self.columnar:
+            save_columnar(self.result_path, [record for record in self.lines if record is not None])
+        elif self.incremental and self.appended is not None and not final and self.appended + len(self.dirty) <= len(self.lines):
+            rows = sorted(self.dirty)
+            append_lines(self.result_path, (_row_line(i, self.lines[i]) for i in rows))
+            self.appended += len(rows)
+        elif final and self.appended == 0 and len(self.dirty) == 0:
+            return  # 追記分がなければ書き直さない
+        else:
+            write_atomic(self.result_path, (line for line in self.lines if line is not None))
+            self.appended = 0
+        self.dirty.clear()
+        self.writes += 1
+
+    def run(self):
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            # 溜まっている更新はまとめて反映し、書き込みは1回にする
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            needs_write = False
+            for item in items:
+                if item is None:
+                    stop = needs_write = True
+                    continue
+                changes, write = item
+                self.apply(changes)
+                needs_write = needs_write or write
+            try:
+                if needs_write:
+                    self.write(final=stop)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Flushes the queued updates and waits for the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread is not None:
+            previous_handler = self.previous_handler
+            self.critical = True
+            try:
+                self.queue.put(None)
+                self.thread.join()
+            finally:
+                self.critical = False
+            atexit.unregister(self.close)
+            self._restore_signal_handler()
+            if self.error:
+                raise self.error
+            self._raise_deferred(previous_handler)
+        else:
+            self.write(final=True)
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _row_line(i, line: str) -> str:
+    # {"_row": i, ...} として、読み込み時に i 番目のレコードを置き換える
+    return f'{{"_row": {i}}}' if line == '{}' else f'{{"_row": {i}, {line[1:]}'
+
+def append_lines(result_path, lines):
+    """Appends JSON lines to the result file (compressed files get a new member/frame) and fsyncs it."""
+    with open_records(result_path, 'a') as w:
+        for line in lines:
+            w.write(line)
+            w.write('\n')
+    fd = os.open(result_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# コンパクト形式
+# 抽出結果や生成コードは model_outputs の部分文字列なので、
+# 文字列のコピーではなく [start, end] のスパンとして保存する
+
+def _to_span(output: str, text: str, prefix=''):
+    if isinstance(text, str) and text.startswith(prefix):
+        start = output.find(text[len(prefix):])
+        if start != -1:
+            return [start, start + len(text) - len(prefix)]
+    return text
+
+def _from_span(output: str, span, prefix=''):
+    if isinstance(span, list):
+        start, end = span
+        return prefix + output[start:end]
+    return span
+
+def compact_record(record: dict) -> dict:
+    """Returns a compact copy of the record that stores substrings of model_outputs as spans."""
+    if 'model_outputs' not in record or record.get('_compact'):
+        return record
+    outputs = record['model_outputs']
+    compacted = {'_compact': 1}
+    for key, value in record.items():
+        if key in ('model_output', 'extracted_result'):
+            continue  # model_outputs[0], extracted_results[0] と同じ
+        if key == 'extracted_results':
+            value = [_to_span(o, x) for o, x in zip(outputs, value)]
+        elif key == 'generated_code' and 'model_input' in record:
+            prefix = record['model_input'] + '\n'
+            value = [_to_span(o, x, prefix) for o, x in zip(outputs, value)]
+        compacted[key] = value
+    return compacted
+
+def expand_record(record: dict) -> dict:
+    """Expands a compact record into the full record format."""
+    if not record.pop('_compact', None):
+        return record
+    outputs = record['model_outputs']
+    record['model_output'] = outputs[0]
+    if 'extracted_results' in record:
+        record['extracted_results'] = [_from_span(o, x) for o, x in zip(outputs, record['extracted_results'])]
+        record['extracted_result'] = record['extracted_results'][0]
+    if 'generated_code' in record:
+        prefix = record.get('model_input', '') + '\n'
+        record['generated_code'] = [_from_span(o, x, prefix) for o, x in zip(outputs, record['generated_code'])]
+    return record
+
+# 列指向形式 (Parquet/Arrow IPC)
+# JSONL の横に保存し、集計時は JSON をパースせずにメモリマップで読み込む
+
+COLUMNAR_SUFFIXES = ('.parquet', '.arrow')
+
+_STRING_COLUMNS = ['unique_id', 'model_input', 'reference', 'model_output', 'extracted_result']
+_LIST_COLUMNS = ['model_outputs', 'extracted_results']
+_TIME_COLUMNS = ['inference_time']
+_ARROW_TYPES = {str: lambda: pa.string(), int: lambda: pa.int64(), bool: lambda: pa.bool_(), float: lambda: pa.float64()}
+
+def is_columnar(path: str):
+    return path.endswith(COLUMNAR_SUFFIXES)
+
+def columnar_path(result_path, result_format='parquet'):
+    return result_base(result_path) + f'.{result_format}'
+
+def _scalar_type(value):
+    """Returns the exact Python type of a scalar that has a native Arrow column type."""
+    value_type = type(value)
+    if value_type is int and not (-2**63 <= value < 2**63):
+        return None  # int64 に収まらない値は JSON として保持する
+    return value_type if value_type in _ARROW_TYPES else None
+
+def _check_pyarrow(args=None):
+    if pa is None:
+        if args:
+            args.raise_uninstalled_module('pyarrow')
+        raise ModuleNotFoundError('pyarrow is required for Parquet/Arrow result files')
+
+def _conforms(key, value, column_types):
+    if key in _LIST_COLUMNS:
+        return isinstance(value, list) and all(isinstance(x, str) for x in value)
+    return _scalar_type(value) is column_types[key]
+
+def records_to_table(records: List[dict]):
+    """
+    Converts records into an Arrow table with a stable schema.
+    Scalar keys keep their native type (str, int64, bool; only float scores become float64 columns).
+    """
+    # キーごとに最も多い型を列の型にする
+    counts = {}
+    for record in records:
+        for key, value in record.items():
+            value_type = _scalar_type(value)
+            if key not in _LIST_COLUMNS and value_type is not None:
+                counts.setdefault(key, Counter())[value_type] += 1
+    column_types = {key: counter.most_common(1)[0][0] for key, counter in counts.items()}
+    for key in _STRING_COLUMNS:
+        column_types.setdefault(key, str)
+    for key in _TIME_COLUMNS:
+        column_types.setdefault(key, float)
+    fixed = _STRING_COLUMNS + _TIME_COLUMNS
+    fields = [pa.field(key, pa.list_(pa.string())) for key in _LIST_COLUMNS]
+    for key in fixed + sorted(key for key in column_types if key not in fixed):
+        fields.append(pa.field(key, _ARROW_TYPES[column_types[key]]()))
+    columns = {field.name: [] for field in fields}
+    # 型の合わない値やその他のキー (code_eval_results など) は JSON 文字列として保持する
+    extras = []
+    for record in records:
+        extra = dict(record)
+        for key in columns:
+            value = extra.get(key)
+            if _conforms(key, value, column_types):
+                del extra[key]
+                columns[key].append(value)
+            else:
+                columns[key].append(None)
+        extras.append(json.dumps(extra, ensure_ascii=False))
+    fields.append(pa.field('extra', pa.string()))
+    columns['extra'] = extras
+    return pa.table([columns[field.name] for field in fields], schema=pa.schema(fields))
+
+def save_columnar(path, records: List[dict], args=None):
+    _check_pyarrow(args)
+    table = records_to_table([expand_record(dict(record)) for record in records])
+    # 途中で中断しても既存のファイルが壊れないように、一時ファイルに書き込んでから置き換える
+    tmp_path = os.path.join(os.path.dirname(path), f'.tmp-{os.getpid()}-{os.path.basename(path)}')
+    if path.endswith('.parquet'):
+        pq.write_table(table, tmp_path)
+    else:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def read_table(path, columns=None):
+    """Reads a Parquet/Arrow file with memory-mapped (zero-copy) IO."""
+    _check_pyarrow()
+    if path.endswith('.parquet'):
+        return pq.read_table(path, columns=columns, memory_map=True)
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    if columns:
+        table = table.select(columns)
+    return table
+
+def load_columnar(path) -> List[dict]:
+    records = []
+    for row in read_table(path).to_pylist():
+        record = json.loads(row.pop('extra') or '{}')
+        for key, value in row.items():
+            if value is not None:
+                record[key] = value
+        records.append(record)
+    return records
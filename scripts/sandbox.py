@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import queue
+import select
+import signal
+import importlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ModuleNotFoundError:
+    ## Windows には resource がないので、サンドボックスは使えない
+    resource = None
+
+# =====================
+# Sandbox Workers
+# =====================
+#
+# 生成されたコードを資源制限つきで実行するワーカープール
+#
+# 各ワーカーは標準ライブラリだけを読み込んだ小さなプロセス (torch などは読み込まない) で、
+# forkserver のように、実行ごとに自分自身から子プロセスを fork する。子プロセスは setrlimit
+# (CPU時間, アドレス空間, ファイル数, ファイルサイズ, プロセス数) をかけ、専用の一時ディレクトリで実行する。
+# 子プロセスは結果を自分の pid つきの JSON 1行としてパイプに書き、ワーカーはその pid の結果だけを読む
+# (候補のコードが fork しても結果が混ざらない)。ワーカーとは標準入出力で JSON を1行ずつやりとりする。
+# ワーカーは recycle_after 回実行するか、制限違反 (タイムアウトなど) があると作り直す。
+
+PRELOAD_MODULES = [
+    'collections', 'itertools', 'functools', 'math', 're', 'string', 'heapq', 'bisect',
+    'typing', 'json', 'random', 'statistics', 'fractions', 'decimal', 'datetime', 'copy',
+    'operator', 'hashlib', 'resource', 'tempfile',
+]
+
+MB = 1024 * 1024
+
+def _set_limit(name, value):
+    if value is None or not hasattr(resource, name):
+        return
+    try:
+        resource.setrlimit(getattr(resource, name), (value, value))
+    except (ValueError, OSError):
+        pass  # ハードリミットを超える値は設定できない
+
+def _apply_limits(limits: dict):
+    cpu = limits.get('cpu_time')
+    if cpu is not None and hasattr(resource, 'RLIMIT_CPU'):
+        # ソフトリミットで SIGXCPU、1秒後にハードリミットで SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    _set_limit('RLIMIT_AS', limits.get('memory'))
+    _set_limit('RLIMIT_NOFILE', limits.get('max_files'))
+    _set_limit('RLIMIT_FSIZE', limits.get('file_size'))
+    # RLIMIT_NPROC はユーザーのプロセス (スレッド) 数の上限なので、0 で新しいプロセスを作れなくする (root には効かない)
+    _set_limit('RLIMIT_NPROC', limits.get('max_procs'))
+    _set_limit('RLIMIT_CORE', 0)
+
+def _frame(violation: bool, status: str) -> bytes:
+    # PIPE_BUF (4096バイト) 以下なら1回の write で書き込まれ、他のプロセスの書き込みと混ざらない
+    frame = json.dumps({'pid': os.getpid(), 'violation': violation, 'result': status[:1000]}) + '\n'
+    return frame.encode('utf-8', errors='replace')[:4000]
+
+def _read_frame(output: bytes, pid: int):
+    """Returns the result written by the child itself (not by processes it forked), or None."""
+    for line in output.split(b'\n')[:-1]:
+        try:
+            frame = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(frame, dict) and frame.get('pid') == pid:
+            return frame
+    return None
+
+def _exec_child(job: dict, limits: dict, write_fd: int):
+    """Runs in the forked child: never returns."""
+    status = 'passed'
+    violation = False
+    try:
+        os.setsid()  # タイムアウト時にプロセスグループごと終了させる
+        # 結果を書き込むパイプ以外 (ワーカーとの通信路など) は閉じる
+        os.closerange(3, write_fd)
+        os.closerange(write_fd + 1, 1024)
+        os.chdir(job['cwd'])
+        null_fd = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null_fd, fd)
+        _apply_limits(limits)
+        if 'argv' in job:
+            # 実行ファイルが終了するまでパイプを開いたままにして、終了を検知できるようにする
+            os.set_inheritable(write_fd, True)
+            os.execv(job['argv'][0], job['argv'])
+        # code_eval と同じく空のグローバルで実行する (__name__ は '__main__' にならない)
+        exec(compile(job['program'], '<candidate>', 'exec'), {})
+    except SystemExit as e:
+        # sys.exit(0) や exit() で残りのテストを飛ばしても合格にはしない
+        status = f'failed: SystemExit({e.code})'
+    except BaseException as e:
+        status = f'failed: {type(e).__name__}: {e}'[:1000]
+        # 資源制限による失敗はワーカーを作り直す
+        violation = isinstance(e, MemoryError) or (isinstance(e, OSError) and e.errno in (errno.EFBIG, errno.EMFILE))
+    try:
+        os.write(write_fd, _frame(violation, status))
+    finally:
+        os._exit(0)
+
+def _signal_result(status: int):
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        if signum in (signal.SIGXCPU, signal.SIGKILL):
+            return 'failed: CPU time limit exceeded', True
+        if signum == signal.SIGXFSZ:
+            return 'failed: file size limit exceeded', True
+        # assert の失敗 (SIGABRT) などは通常の失敗として扱う
+        return f'failed: killed by signal {signum}', False
+    code = os.WEXITSTATUS(status)
+    return ('passed', False) if code == 0 else (f'failed: exit status {code}', False)
+
+def run_job(job: dict, limits: dict, timeout: float) -> dict:
+    """Forks a child that executes the job under the resource limits and waits for the result."""
+    limits = dict(limits, **job.get('limits', {}))
+    read_fd, write_fd = os.pipe()
+    with tempfile.TemporaryDirectory(prefix='sandbox_') as cwd:
+        job = dict(job, cwd=cwd)
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _exec_child(job, limits, write_fd)
+        os.close(write_fd)
+        output = b''
+        frame = None
+        status = None
+        timed_out = False
+        deadline = time.monotonic() + timeout
+        while frame is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            ready, _, _ = select.select([read_fd], [], [], min(remaining, 0.1))
+            if ready:
+                data = os.read(read_fd, 4096)
+                if not data:
+                    break
+                output += data
+                frame = _read_frame(output, pid)
+                continue
+            # fork したプロセスがパイプを開いたままでも、子プロセスの終了を検知する
+            finished, status = os.waitpid(pid, os.WNOHANG)
+            if finished:
+                ready, _, _ = select.select([read_fd], [], [], 0)
+                if ready:
+                    frame = _read_frame(output + os.read(read_fd, 4096), pid)
+                break
+            status = None
+        os.close(read_fd)
+        # 子プロセスが fork したプロセスも含めて、プロセスグループごと終了させる
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if status is None:
+            _, status = os.waitpid(pid, 0)
+    if timed_out:
+        return {'passed': False, 'result': 'timed out', 'violation': True}
+    if frame is not None:
+        return {'passed': frame['result'] == 'passed', 'result': frame['result'], 'violation': frame['violation']}
+    # exec した実行ファイルや、シグナルで終了した場合は終了ステータスで判定する
+    result, violation = _signal_result(status)
+    return {'passed': result == 'passed', 'result': result, 'violation': violation}
+
+def worker_main():
+    """Entry point of a sandbox worker process: reads jobs from stdin and writes results to stdout."""
+    limits = json.loads(sys.argv[1])
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    channel = os.fdopen(os.dup(1), 'w')
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            result = run_job(request['job'], limits, request['timeout'])
+        except Exception as e:
+            result = {'passed': False, 'result': f'failed: sandbox error: {e}', 'violation': True}
+        channel.write(json.dumps(result) + '\n')
+        channel.flush()
+
+class _Worker(object):
+
+    def __init__(self, limits):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen([sys.executable, '-c', 'import sandbox; sandbox.worker_main()', json.dumps(limits)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        env=env, text=True, encoding='utf-8')
+        self.executions = 0
+
+    def run(self, job, timeout):
+        self.executions += 1
+        self.process.stdin.write(json.dumps({'job': job, 'timeout': timeout}, ensure_ascii=False) + '\n')
+        self.process.stdin.flush()
+        # 子プロセスの終了待ちの時間も含めて余裕をもたせる
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout + 5)
+        line = self.process.stdout.readline() if ready else ''
+        if not line:
+            raise TimeoutError('sandbox worker is not responding')
+        return json.loads(line)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+class SandboxPool(object):
+    """
+    A pool of sandbox workers. Each execution runs in a fresh child process
+    with CPU time, address space, open file, file size and process limits.
+    """
+
+    def __init__(self, num_workers=4, timeout=3.0, cpu_time=None, memory_mb=1024,
+                 max_files=64, file_size_mb=16, max_procs=0, recycle_after=100):
+        if resource is None or not hasattr(os, 'fork'):
+            raise RuntimeError('The sandbox requires a POSIX system (resource, fork)')
+        self.num_workers = max(num_workers, 1)
+        self.timeout = timeout
+        self.limits = {
+            'cpu_time': cpu_time or int(timeout) + 1,
+            'memory': memory_mb * MB if memory_mb else None,
+            'max_files': max_files,
+            'file_size': file_size_mb * MB if file_size_mb else None,
+            'max_procs': max_procs,
+        }
+        self.recycle_after = recycle_after
+        self.idle = queue.Queue()
+        for _ in range(self.num_workers):
+            self.idle.put(None)  # ワーカーは最初に使うときに起動する
+        self.lock = threading.Lock()
+        self.executions = 0
+        self.recycled = 0
+        self.violations = 0
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(num_workers=args['sandbox_workers|=4'],
+                   timeout=args['sandbox_timeout|timeout|=3.0'],
+                   cpu_time=args['sandbox_cpu_time'],
+                   memory_mb=args['sandbox_memory|=1024'],
+                   max_files=args['sandbox_max_files|=64'],
+                   file_size_mb=args['sandbox_file_size|=16'],
+                   max_procs=args['sandbox_max_procs|=0'],
+                   recycle_after=args['sandbox_recycle|=100'])
+
+    @property
+    def batch_size(self):
+        return self.num_workers * 8
+
+    def run_one(self, job: dict) -> dict:
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                worker = _Worker(self.limits)
+            try:
+                result = worker.run(job, self.timeout)
+            except (OSError, ValueError, TimeoutError) as e:
+                result = {'passed': False, 'result': f'failed: sandbox worker crashed ({type(e).__name__})', 'violation': True}
+            with self.lock:
+                self.executions += 1
+                self.violations += int(result['violation'])
+            if result['violation'] or worker.executions >= self.recycle_after:
+                worker.close()
+                worker = None
+                with self.lock:
+                    self.recycled += 1
+        finally:
+            self.idle.put(worker)
+        return {'passed': result['passed'], 'result': result['result']}
+
+    def run(self, jobs: list) -> list:
+        """Executes the jobs in parallel and returns the results in the same order."""
+        if len(jobs) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.num_workers, len(jobs))) as executor:
+            return list(executor.map(self.run_one, jobs))
+
+    def run_programs(self, programs: list) -> list:
+        return self.run([{'program': program} for program in programs])
+
+    def stats(self):
+        return f'executions={self.executions} violations={self.violations} recycled={self.recycled}'
+
+    def close(self):
+        while not self.idle.empty():
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+
+# =====================
+# Compiled Languages
+# =====================
+#
+# C++ と JavaScript のプログラムをソースのハッシュごとに一度だけコンパイル (構文チェック) し、
+# 成果物を cache_dir に保存して、実行はサンドボックスで行う。
+# C++ は bits/stdc++.h のプリコンパイル済みヘッダを使う (ハーネスの #include のコンパイルが大半を占めるため)
+
+EXECUTABLE_LANGUAGES = ('cpp', 'js')
+
+class CompileCache(object):
+    """Compiles programs once per source hash and returns sandbox jobs that run them."""
+
+    def __init__(self, language, cache_dir, timeout=30, num_workers=4, memory_mb=1024, cxx='g++', cxx_flags='-std=c++17'):
+        if language not in EXECUTABLE_LANGUAGES:
+            raise ValueError(f'Unsupported language: {language}')
+        self.language = language
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), language)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.timeout = timeout
+        self.num_workers = max(num_workers, 1)
+        self.memory_mb = memory_mb
+        self.hits = 0
+        self.compiled = 0
+        if language == 'cpp':
+            self.compiler = shutil.which(cxx)
+            self.flags = cxx_flags.split()
+            if self.compiler is None:
+                raise RuntimeError(f'C++ compiler is not found: {cxx}')
+            self.pch = self.build_pch()
+        else:
+            self.node = shutil.which('node')
+            if self.node is None:
+                raise RuntimeError('node is not found')
+
+    def settings(self) -> dict:
+        """Returns the compiler settings that change execution results."""
+        if self.language == 'cpp':
+            return {'compiler': self.compiler, 'flags': self.flags}
+        return {'node': self.node, 'memory_mb': self.memory_mb}
+
+    @classmethod
+    def from_args(cls, language, args):
+        return cls(language, args['compile_cache|=~/.cache/lm-chaineval/compile'],
+                   timeout=args['compile_timeout|=30'],
+                   num_workers=args['compile_workers|sandbox_workers|=4'],
+                   memory_mb=args['sandbox_memory|=1024'],
+                   cxx=args['cxx|=g++'],
+                   cxx_flags=args['cxx_flags|=-std=c++17'])
+
+    def build_pch(self):
+        """Builds a precompiled header of bits/stdc++.h (None if the compiler does not support it)."""
+        digest = hashlib.sha256(' '.join([self.compiler] + self.flags).encode('utf-8')).hexdigest()[:16]
+        pch_dir = os.path.join(self.cache_dir, f'pch-{digest}')
+        header = os.path.join(pch_dir, 'stdc++.h')
+        if os.path.exists(header + '.gch'):
+            return header
+        os.makedirs(pch_dir, exist_ok=True)
+        with open(header, 'w') as f:
+            f.write('#include <bits/stdc++.h>\n')
+        tmp = f'{header}.gch.{os.getpid()}'
+        try:
+            subprocess.run([self.compiler] + self.flags + ['-x', 'c++-header', header, '-o', tmp],
+                           capture_output=True, timeout=self.timeout * 4, check=True)
+            os.replace(tmp, header + '.gch')
+            return header
+        except (subprocess.SubprocessError, OSError):
+            return None
+
+    def source_hash(self, source: str):
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def compile(self, source: str):
+        """Returns the path of the compiled artefact and the compile error (None if compiled)."""
+        base = os.path.join(self.cache_dir, self.source_hash(source))
+        artefact = base + ('.bin' if self.language == 'cpp' else '.js')
+        error_path = base + '.err'
+        if os.path.exists(artefact):
+            self.hits += 1
+            return artefact, None
+        if os.path.exists(error_path):
+            self.hits += 1
+            with open(error_path, encoding='utf-8') as f:
+                return None, f.read()
+        # 他のプロセスと競合しないように一時ファイルに作ってから rename する
+        tmp = f'{base}.{os.getpid()}.{threading.get_ident()}'
+        ext = '.cpp' if self.language == 'cpp' else '.js'
+        with open(tmp + ext, 'w', encoding='utf-8') as f:
+            f.write(source)
+        if self.language == 'cpp':
+            command = [self.compiler] + self.flags
+            if self.pch:
+                command += ['-include', self.pch]
+            command += [tmp + ext, '-o', tmp]
+        else:
+            command = [self.node, '--check', tmp + ext]
+        try:
+            completed = subprocess.run(command, capture_output=True, timeout=self.timeout)
+            error = None
+            if completed.returncode != 0:
+                error = completed.stderr.decode('utf-8', errors='replace').replace(tmp + ext, 'main' + ext)[-2000:]
+        except subprocess.TimeoutExpired:
+            error = 'compilation timed out'
+        self.compiled += 1
+        if error is None:
+            os.replace(tmp if self.language == 'cpp' else tmp + ext, artefact)
+        elif error != 'compilation timed out':
+            with open(error_path, 'w', encoding='utf-8') as f:
+                f.write(error)
+        for path in (tmp, tmp + ext):
+            if os.path.exists(path):
+                os.remove(path)
+        return (artefact if error is None else None), error
+
+    def job(self, artefact: str) -> dict:
+        if self.language == 'cpp':
+            return {'argv': [artefact]}
+        # V8 は大きな仮想メモリを予約するので、アドレス空間ではなくヒープサイズで制限する
+        # node はスレッドを使うので、プロセス数は制限しない
+        return {'argv': [self.node, f'--max-old-space-size={self.memory_mb}', artefact], 'limits': {'memory': None, 'max_procs': None}}
+
+    def compile_all(self, sources: list) -> list:
+        """Compiles unique sources in parallel and returns (artefact, error) for each source."""
+        unique = list(dict.fromkeys(sources))
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            compiled = dict(zip(unique, executor.map(self.compile, unique)))
+        return [compiled[source] for source in sources]
+
+    def run(self, sandbox: SandboxPool, sources: list) -> list:
+        """Compiles and executes the sources, returning results in the code_eval format."""
+        results = [None] * len(sources)
+        jobs = []
+        for i, (artefact, error) in enumerate(self.compile_all(sources)):
+            if error is None:
+                jobs.append((i, self.job(artefact)))
+            elif error == 'compilation timed out':
+                # 一時的な失敗として扱い、実行キャッシュに保存させない
+                results[i] = {'passed': False, 'result': 'failed: compilation timed out'}
+            else:
+                results[i] = {'passed': False, 'result': f'failed: compilation error: {error}'}
+        for (i, _), result in zip(jobs, sandbox.run([job for _, job in jobs])):
+            results[i] = result
+        return results
+
+    def stats(self):
+        return f'compiled={self.compiled} cache_hits={self.hits}'
@@ -0,0 +1,124 @@
+import math
+from statistics import NormalDist
+
+# =====================
+# Sequential Evaluation
+# =====================
+#
+# レコードをランダムな順序で評価し、信頼区間が十分に狭くなった時点で打ち切る
+#
+# --target_precision 0.02     信頼区間の半幅が 0.02 以下になったら停止
+# --threshold 0.5             信頼区間が 0.5 を含まなくなったら停止
+#
+# [0,1] のスコア (pass@1, exact_match など) は Wilson の信頼区間を使う (正規近似は全て 0 のときに幅が 0 になる)。
+# 途中で何度も停止を判定するので、k 回目の判定では有意水準 alpha * 6/(π²k²) を使い、
+# 全体の誤り率が alpha を超えないようにする。
+
+def wilson_interval(mean, n, z, population=None):
+    """Wilson score interval of a proportion (with the finite population correction)."""
+    if population and population > 1:
+        if n >= population:
+            return mean, mean
+        # 非復元抽出の有限母集団修正 (分散を縮める分、実効的なサンプル数を増やす)
+        n = n * (population - 1) / (population - n)
+    denominator = 1 + z * z / n
+    center = (mean + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(mean * (1 - mean) / n + z * z / (4 * n * n)) / denominator
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+class RunningEstimate(object):
+    """Running mean and variance (Welford's algorithm) with a confidence interval."""
+
+    def __init__(self, population=None):
+        self.population = population
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.bounded = True  # すべての値が [0,1] に収まるか
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.bounded = self.bounded and 0 <= value <= 1
+
+    def interval(self, confidence=0.95):
+        if self.n < 2:
+            return -math.inf, math.inf
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        if self.bounded:
+            return wilson_interval(min(max(self.mean, 0.0), 1.0), self.n, z, self.population)
+        variance = self.m2 / (self.n - 1) / self.n
+        if self.population and self.population > 1:
+            # 非復元抽出の有限母集団修正
+            variance *= max(self.population - self.n, 0) / (self.population - 1)
+        half_width = z * math.sqrt(variance)
+        return self.mean - half_width, self.mean + half_width
+
+class SequentialEstimator(object):
+
+    def __init__(self, metric_id, args, population, baseline_records=None):
+        self.metric_id = metric_id
+        self.confidence = args['confidence|=0.95']
+        self.target_precision = args['target_precision']
+        self.threshold = args['threshold']
+        self.min_records = args['min_records|=30']
+        self.baseline = None
+        if baseline_records is not None:
+            self.baseline = {record['unique_id']: record[metric_id]
+                             for record in baseline_records if metric_id in record}
+        self.estimate = RunningEstimate(population)
+        self.difference = RunningEstimate(population)
+        self.population = population
+        self.looks = 0
+        self.stop_reason = None
+
+    def look_confidence(self):
+        """Returns the confidence of the current look (alpha spent as alpha * 6/(pi^2 k^2) over the looks)."""
+        if self.looks == 0:
+            return self.confidence
+        alpha = 1 - self.confidence
+        return 1 - alpha * 6 / (math.pi ** 2 * self.looks ** 2)
+
+    def update(self, record):
+        score = record[self.metric_id]
+        self.estimate.update(score)
+        if self.baseline is not None and record['unique_id'] in self.baseline:
+            self.difference.update(score - self.baseline[record['unique_id']])
+
+    def should_stop(self):
+        if self.estimate.n < self.min_records:
+            return False
+        self.looks += 1
+        confidence = self.look_confidence()
+        lower, upper = self.estimate.interval(confidence)
+        if self.target_precision is not None and (upper - lower) / 2 <= self.target_precision:
+            self.stop_reason = f'precision <= {self.target_precision}'
+        elif self.threshold is not None and (lower > self.threshold or upper < self.threshold):
+            self.stop_reason = f'{"above" if lower > self.threshold else "below"} threshold {self.threshold}'
+        elif self.baseline is not None and self.difference.n >= self.min_records:
+            lower, upper = self.difference.interval(confidence)
+            if lower > 0 or upper < 0:
+                self.stop_reason = f'{"better" if lower > 0 else "worse"} than baseline'
+        return self.stop_reason is not None
+
+    def report(self):
+        confidence = self.look_confidence()
+        lower, upper = self.estimate.interval(confidence)
+        report = {
+            'metric': self.metric_id,
+            'mean': self.estimate.mean,
+            'ci_lower': lower,
+            'ci_upper': upper,
+            'confidence': self.confidence,
+            'adjusted_confidence': confidence,
+            'looks': self.looks,
+            'records': self.estimate.n,
+            'fraction': self.estimate.n / max(self.population, 1),
+            'stop_reason': self.stop_reason or 'exhausted',
+        }
+        if self.baseline is not None:
+            lower, upper = self.difference.interval(confidence)
+            report.update({'difference': self.difference.mean, 'difference_ci_lower': lower, 'difference_ci_upper': upper})
+        return report
@@ -0,0 +1,72 @@
+import json
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from models import load_model
+from adhoc import adhoc_argument_parser
+
+# =====================
+# Model Server
+# =====================
+#
+# モデルを一度だけロードして、main.py からの生成リクエストを受け付ける
+#
+# python3 ./scripts/server.py --model_path <MODEL_PATH> --port 8800
+# python3 ./scripts/main.py --model_server http://127.0.0.1:8800 --dataset ... --template ...
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    model = None
+
+    def log_message(self, format, *args):
+        pass  # リクエストごとのログは出さない
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/info':
+            self.send_json({'model': str(self.model), 'context_length': self.model.context_length,
+                            'sampling_config': self.model.sampling_config()})
+        else:
+            self.send_json({'error': f'Unknown path: {self.path}'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        try:
+            if self.path == '/generate':
+                outputs = self.model.generate_list(request['prompt'],
+                                                   n=request.get('n', 1),
+                                                   max_new_tokens=request.get('max_new_tokens'),
+                                                   seed=request.get('seed'))
+                self.send_json({'outputs': outputs})
+            elif self.path == '/estimate_tokens':
+                self.send_json({'lengths': self.model.estimate_tokens(request['prompts'])})
+            elif self.path == '/prompt_tokens':
+                self.send_json({'lengths': self.model.prompt_tokens(request['prompts'])})
+            elif self.path == '/truncate_prompt':
+                self.send_json({'prompt': self.model.truncate_prompt(request['prompt'], request['max_tokens'])})
+            else:
+                self.send_json({'error': f'Unknown path: {self.path}'}, status=404)
+        except Exception as e:
+            self.send_json({'error': f'{type(e).__name__}: {e}'}, status=500)
+
+def main():
+    args = adhoc_argument_parser(expand_config='config')
+    model = load_model(args)
+    host = args['host|=127.0.0.1']
+    port = args['port|=8800']
+    ModelRequestHandler.model = model
+    server = HTTPServer((host, port), ModelRequestHandler)
+    args.verbose_print(f'モデルサーバ//Model server: {model} http://{host}:{port}')
+    args.utils_check()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+from typing import List
+import os
+import glob
+import socket
+import threading
+import time
+from records import load_records, result_base, compression_suffix
+
+# =====================
+# Sharded Evaluation
+# =====================
+
+def shard_range(num_records, shard_index, num_shards):
+    """Returns the contiguous range [start, end) of records assigned to the shard."""
+    chunk_size = (num_records + num_shards - 1) // num_shards
+    start = min(shard_index * chunk_size, num_records)
+    return start, min(start + chunk_size, num_records)
+
+def shard_dir(result_path):
+    return result_base(result_path) + '_shards'
+
+def partial_path(result_path, start, end):
+    """Each worker writes the records [start, end) to its own partial result file."""
+    ext = '.jsonl' + compression_suffix(result_path)
+    return os.path.join(shard_dir(result_path), f'{start:08d}-{end:08d}{ext}')
+
+def merge_shards(result_path) -> List[dict]:
+    """Merges partial result files into one list of records in the original order."""
+    records = []
+    expected = 0
+    for path in sorted(glob.glob(os.path.join(shard_dir(result_path), '*-*.jsonl*'))):
+        name = os.path.basename(path).partition('.')[0]
+        start, _, end = name.partition('-')
+        start, end = int(start), int(end)
+        if start < expected:
+            continue  # 同じ範囲を複数のワーカーが処理した場合
+        if start > expected:
+            print(f'🐥 欠けている範囲があります//Missing records: [{expected}, {start})')
+        records.extend(load_records(path, None))
+        expected = end
+    return records
+
+class WorkQueue(object):
+    """
+    共有ファイルシステム上のロックフリーな作業キュー
+    レコードを shard_size 件ずつの範囲に分け、各範囲の lease ファイル (<範囲>.lease.<世代>) を
+    O_CREAT|O_EXCL で作成できたワーカーがその範囲を処理する。
+    lease は処理中に更新され、最新の世代の lease が lease_ttl 秒以上更新されない場合は
+    クラッシュしたワーカーのものとして、次の世代の lease を O_EXCL で作成できた1つのワーカーだけが引き継ぐ。
+    (古い lease を削除しないので、引き継いだばかりの lease が他のワーカーに消されることはない)
+    """
+
+    def __init__(self, queue_dir, num_records, shard_size=1000, lease_ttl=600):
+        os.makedirs(queue_dir, exist_ok=True)
+        self.queue_dir = queue_dir
+        self.ranges = [(start, min(start + shard_size, num_records))
+                       for start in range(0, num_records, shard_size)]
+        self.lease_ttl = lease_ttl
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.generations = {}  # このワーカーが持っている lease の世代
+
+    def _path(self, start, end, suffix):
+        return os.path.join(self.queue_dir, f'{start:08d}-{end:08d}.{suffix}')
+
+    def _lease_generations(self) -> dict:
+        """Returns the generations of the existing leases of each range."""
+        generations = {}
+        for name in os.listdir(self.queue_dir):
+            base, _, generation = name.rpartition('.lease.')
+            if base and generation.isdigit():
+                generations.setdefault(base, []).append(int(generation))
+        return generations
+
+    def _try_lease(self, start, end, generations):
+        if len(generations) > 0:
+            latest = max(generations)
+            try:
+                if time.time() - os.stat(self._path(start, end, f'lease.{latest}')).st_mtime < self.lease_ttl:
+                    return False
+            except FileNotFoundError:
+                return False  # 完了して削除された
+            generation = latest + 1
+        else:
+            generation = 0
+        # 同じ世代の lease を作成できるのは1つのワーカーだけなので、引き継ぎも排他的になる
+        try:
+            fd = os.open(self._path(start, end, f'lease.{generation}'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker_id)
+        self.generations[(start, end)] = generation
+        return True
+
+    def claim(self):
+        """Claims an unfinished range and returns (start, end), or None if nothing is left."""
+        leases = self._lease_generations()
+        for start, end in self.ranges:
+            if os.path.exists(self._path(start, end, 'done')):
+                continue
+            if self._try_lease(start, end, leases.get(f'{start:08d}-{end:08d}', [])):
+                return start, end
+        return None
+
+    def owns(self, start, end):
+        """Checks that no other worker has taken over the range (no newer lease generation exists)."""
+        generation = self.generations.get((start, end))
+        if generation is None:
+            return False
+        return not os.path.exists(self._path(start, end, f'lease.{generation + 1}'))
+
+    def renew(self, start, end):
+        generation = self.generations.get((start, end))
+        if generation is None:
+            return
+        try:
+            os.utime(self._path(start, end, f'lease.{generation}'))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, start, end):
+        with open(self._path(start, end, 'done'), 'w') as f:
+            f.write(self.worker_id)
+        for generation in range(self.generations.pop((start, end), 0) + 1):
+            try:
+                os.remove(self._path(start, end, f'lease.{generation}'))
+            except FileNotFoundError:
+                pass
+
+    def remaining(self):
+        return sum(1 for start, end in self.ranges if not os.path.exists(self._path(start, end, 'done')))
+
+    def heartbeat(self, start, end):
+        """Starts a thread that keeps the lease alive while the range is processed."""
+        stop = threading.Event()
+        def renew_lease():
+            while not stop.wait(self.lease_ttl / 3):
+                self.renew(start, end)
+        thread = threading.Thread(target=renew_lease, daemon=True)
+        thread.start()
+        return stop
@@ -0,0 +1,386 @@
+from typing import List
+import re
+import json
+import hashlib
+from functools import partial
+from multiprocessing import Pool
+from profiling import profiling_enabled, profile_stage
+
+# =====================
+# Pre-inference Stages
+# =====================
+
+def _render_chunk(template, rows):
+    return [(template.create_prompt(row), template.create_reference(row)) for row in rows]
+
+def _extract_chunk(template, outputs_list):
+    return [template.extract(outputs) for outputs in outputs_list]
+
+def map_chunks(func, inputs: list, num_workers=1, chunk_size=1000):
+    """
+    Applies func to chunks of inputs and yields (start, results) in order.
+    With num_workers > 1, chunks are processed on a process pool.
+    """
+    starts = range(0, len(inputs), chunk_size)
+    if num_workers > 1 and len(inputs) > chunk_size:
+        with Pool(num_workers) as pool:
+            chunks = (inputs[start:start+chunk_size] for start in starts)
+            for start, results in zip(starts, pool.imap(func, chunks)):
+                yield start, results
+    else:
+        for start in starts:
+            yield start, func(inputs[start:start+chunk_size])
+
+def render_records(records: List[dict], dataset, template, indices=None, num_workers=1, chunk_size=1000):
+    """Renders model_input and reference for all records (or the given indices) before inference."""
+    if indices is None:
+        indices = range(len(records))
+    targets = [i for i in indices if 'model_input' not in records[i] or 'reference' not in records[i]]
+    if profiling_enabled():
+        # プロファイル時はレコードごとに計測するため、プロセスプールを使わない
+        for i in targets:
+            with profile_stage(records[i], 'render'):
+                ((prompt, reference),) = _render_chunk(template, [dataset[i]])
+                _store_rendered(records[i], template, prompt, reference)
+        return
+    rows = [dataset[i] for i in targets]
+    for start, rendered in map_chunks(partial(_render_chunk, template), rows, num_workers, chunk_size):
+        for i, (prompt, reference) in zip(targets[start:], rendered):
+            _store_rendered(records[i], template, prompt, reference)
+
+def _store_rendered(record: dict, template, prompt, reference):
+    if 'model_input' not in record:
+        record['model_input'] = prompt
+        stamp_stage(record, 'model_input', prompt_fingerprint(template))
+    if 'reference' not in record:
+        record['reference'] = reference
+        stamp_stage(record, 'reference', reference_fingerprint(template))
+
+def extract_records(records: List[dict], template, indices=None, num_workers=1, chunk_size=1000):
+    """Extracts results from model_outputs of all records (or the given indices)."""
+    if indices is None:
+        indices = range(len(records))
+    targets = [i for i in indices if 'extracted_results' not in records[i] and 'model_outputs' in records[i]]
+    if profiling_enabled():
+        for i in targets:
+            with profile_stage(records[i], 'extract'):
+                _store_extracted(records[i], template, template.extract(records[i]['model_outputs']))
+        return
+    outputs_list = [records[i]['model_outputs'] for i in targets]
+    for start, extracted_list in map_chunks(partial(_extract_chunk, template), outputs_list, num_workers, chunk_size):
+        for i, extracted in zip(targets[start:], extracted_list):
+            _store_extracted(records[i], template, extracted)
+
+def _store_extracted(record: dict, template, extracted):
+    record['extracted_results'] = extracted
+    record['extracted_result'] = extracted[0]
+    stamp_stage(record, 'extracted_results', extract_fingerprint(template, record['model_outputs']))
+
+def estimate_costs(records: List[dict], model, n=1, output_tokens=512, indices=None):
+    """Estimates the inference cost of each record (only the given indices; prompt tokens + expected output tokens)."""
+    if indices is None:
+        indices = range(len(records))
+    pending = [i for i in indices if 'model_outputs' not in records[i]]
+    costs = [0] * len(records)
+    prompt_tokens = model.count_prompt_tokens([records[i]['model_input'] for i in pending])
+    for i, num_tokens in zip(pending, prompt_tokens):
+        costs[i] = num_tokens + output_tokens * n
+    return costs
+
+def schedule_records(records: List[dict], model, args, n=1, indices=None, verbose=True) -> List[int]:
+    """
+    Returns the order in which records (or only the given indices) are processed.
+    The records themselves stay in the original order, so results are saved in dataset order.
+    run_inference generates one record at a time, so the order does not reduce padding or the total time.
+    """
+    schedule = args['schedule|=none']
+    order = list(range(len(records))) if indices is None else list(indices)
+    if schedule == 'none':
+        return order
+    output_tokens = args['expected_output_tokens|max_new_tokens|max_tokens|=512']
+    costs = estimate_costs(records, model, n=n, output_tokens=output_tokens, indices=order)
+    if schedule in ('longest', 'longest_first'):
+        order.sort(key=lambda i: costs[i], reverse=True)
+    elif schedule in ('shortest', 'shortest_first'):
+        order.sort(key=lambda i: costs[i])
+    else:
+        args.utils_print(f'未定義のスケジュール//Unknown schedule: {schedule}')
+        return order
+    if verbose:
+        total = sum(costs[i] for i in order)
+        args.verbose_print(f'スケジュール//Schedule: {schedule} estimated tokens={total} max={max(costs, default=0)}')
+    return order
+
+def length_histogram(lengths: List[int]) -> str:
+    """Returns a histogram of token lengths in power-of-two buckets."""
+    buckets = {}
+    for length in lengths:
+        bucket = 1 << max(length - 1, 0).bit_length()
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return ' '.join(f'<={bucket}:{count}' for bucket, count in sorted(buckets.items()))
+
+def is_code_task(args):
+    # pass@k はプロンプトの続きとして生成コードを組み立てる (humaneval_extract) ので、プロンプトを切り詰められない
+    metrics = args['metrics'] or ''
+    return any(metric.strip().startswith('pass@') for metric in metrics.split(','))
+
+def _reset_skipped(record: dict):
+    """Clears the empty outputs of a record skipped for its prompt length so that it is generated again."""
+    keep = {'unique_id', '_fingerprints', *STAGE_KEYS['model_input'], *STAGE_KEYS['reference']}
+    for key in list(record):
+        if key not in keep:
+            del record[key]
+    record.pop('skipped', None)
+    fps = record.get('_fingerprints')
+    if fps:
+        record['_fingerprints'] = {stage: fp for stage, fp in fps.items() if stage in ('model_input', 'reference')}
+
+def budget_prompts(records: List[dict], model, args, n=1, indices=None, verbose=True, stop_sequences=()):
+    """
+    推論前にプロンプトのトークン数を調べ、予算を超えるプロンプトを切り詰める (または推論をスキップする)
+    コード生成 (pass@k) ではプロンプトを切り詰めずにスキップする。
+    スキップしたレコードは、予算を変えて再開したときに収まれば推論し直す。
+    コンテキスト長がわかる場合は、レコードごとに max_new_tokens を設定する。
+    """
+    max_prompt_tokens = args['max_prompt_tokens']
+    overflow = args['prompt_overflow|=truncate']
+    if overflow == 'truncate' and is_code_task(args):
+        overflow = 'skip'
+    if indices is None:
+        indices = range(len(records))
+    skipped_before = [i for i in indices if records[i].get('skipped') == 'prompt_too_long']
+    if len(skipped_before) > 0:
+        lengths = model.count_prompt_tokens([records[i]['model_input'] for i in skipped_before])
+        retried = 0
+        for i, num_tokens in zip(skipped_before, lengths):
+            if max_prompt_tokens is None or num_tokens <= max_prompt_tokens or overflow != 'skip':
+                _reset_skipped(records[i])
+                retried += 1
+        if retried > 0:
+            args.verbose_print(f'スキップしたプロンプトを推論し直します//Retrying {retried} skipped prompts')
+    if max_prompt_tokens is None:
+        return
+    context_length = args['context_length'] or model.context_length
+    max_new_tokens = args['max_new_tokens|max_tokens|=512']
+    pending = [i for i in indices if 'model_outputs' not in records[i]]
+    lengths = model.count_prompt_tokens([records[i]['model_input'] for i in pending])
+    if verbose:
+        args.verbose_print(f'プロンプト長//Prompt tokens: {length_histogram(lengths)}')
+    truncated = skipped = 0
+    for i, num_tokens in zip(pending, lengths):
+        record = records[i]
+        if num_tokens > max_prompt_tokens:
+            if overflow == 'skip':
+                record['skipped'] = 'prompt_too_long'
+                record['model_outputs'] = [''] * n
+                record['model_output'] = ''
+                stamp_outputs(record, n, stop_sequences)
+                skipped += 1
+                continue
+            record['model_input'] = model.truncate_prompt(record['model_input'], max_prompt_tokens)
+            record['prompt_truncated'] = num_tokens
+            # 切り詰めたプロンプトを (チャットテンプレートを含めて) 数え直す
+            num_tokens = model.count_prompt_tokens([record['model_input']])[0]
+            truncated += 1
+        if context_length:
+            record['max_new_tokens'] = max(min(max_new_tokens, context_length - num_tokens), 1)
+    if verbose:
+        args.verbose_print(f'プロンプト予算//Prompt budget {max_prompt_tokens}: 切り詰め//truncated {truncated} スキップ//skipped {skipped}')
+
+def encode_prompts(records: List[dict], model, args, indices=None, batch_size=256):
+    """
+    HF のチャットモデルでは、チャットテンプレートで整形したプロンプトをまとめてトークン化し、
+    レコードの input_ids に保存する (再開時や複数サンプルの生成で再びトークン化しない)
+    """
+    if indices is None:
+        indices = range(len(records))
+    targets = []
+    for i in indices:
+        record = records[i]
+        if 'model_outputs' in record:
+            continue
+        # モデルやテンプレートの設定、切り詰めたプロンプトが変わった場合はトークン化し直す
+        key = model.encoding_key(record['model_input'])
+        if key is None:
+            record.pop('input_ids', None)
+            record.pop('input_ids_key', None)
+        elif record.get('input_ids_key') != key:
+            targets.append(i)
+    for start in range(0, len(targets), batch_size):
+        batch = targets[start:start+batch_size]
+        encoded = model.encode_prompts([records[i]['model_input'] for i in batch])
+        for i, input_ids in zip(batch, encoded):
+            records[i]['input_ids'] = list(input_ids)
+            records[i]['input_ids_key'] = model.encoding_key(records[i]['model_input'])
+    if len(targets) > 0:
+        args.verbose_print(f'トークン化//Tokenized {len(targets)} prompts with the chat template')
+
+# 重複プロンプトの除去
+# 同じプロンプト (空白を正規化して同じもの) と生成設定のレコードは1回だけ生成し、出力をコピーする
+
+_whitespace_pattern = re.compile(r'\s+')
+
+def prompt_key(prompt: str, model, n=1, max_new_tokens=None, normalize=True) -> str:
+    if normalize:
+        prompt = _whitespace_pattern.sub(' ', prompt).strip()
+    return fingerprint('generate', str(model), model.sampling_config(), prompt, n, max_new_tokens)
+
+def dedup_prompts(records: List[dict], model, args, n=1, indices=None) -> dict:
+    """
+    Groups pending records that share the prompt and the sampling configuration.
+    Returns {leader index: [follower indices]}; only leaders are generated.
+    """
+    mode = args['dedup_prompts|=false']
+    if not mode:
+        return {}
+    normalize = mode != 'exact'
+    if indices is None:
+        indices = range(len(records))
+    pending = [i for i in indices if 'model_outputs' not in records[i]]
+    leaders = {}
+    groups = {}
+    for i in pending:
+        key = prompt_key(records[i]['model_input'], model, n=n, 
+                         max_new_tokens=records[i].get('max_new_tokens'), normalize=normalize)
+        if key in leaders:
+            groups.setdefault(leaders[key], []).append(i)
+        else:
+            leaders[key] = i
+    saved = sum(len(followers) for followers in groups.values())
+    args.verbose_print(f'重複プロンプト//Dedup: {len(groups)} groups, {saved}/{len(pending)} generations saved '
+                       f'({saved/max(len(pending), 1):.1%})')
+    args['dedup'] = {'records': len(pending), 'groups': len(groups), 'saved': saved}
+    return groups
+
+def fan_out(records: List[dict], leader: int, followers: List[int]):
+    """Copies the outputs of the leader to the records with the same prompt."""
+    source = records[leader]
+    for i in followers:
+        record = records[i]
+        record['model_outputs'] = list(source['model_outputs'])
+        record['model_output'] = source['model_output']
+        for key in ('seed', 'generation_key'):
+            if key in source:
+                record[key] = source[key]
+        record['inference_time'] = 0.0
+        record['dedup_of'] = source['unique_id']
+        stamp_stage(record, 'model_outputs', source.get('_fingerprints', {}).get('model_outputs'))
+
+# =====================
+# Stage Fingerprints
+# =====================
+#
+# 各ステージの出力に入力 (テンプレート, 抽出設定, 評価尺度のバージョン, モデル出力) の
+# フィンガープリントを付け、変わったステージとその下流だけを再計算する
+# フィンガープリントは各ステージが出力を書いたときに付けるので、途中のチェックポイントにも含まれる
+
+STAGE_KEYS = {
+    'model_input': ['model_input', 'prompt_truncated', 'max_new_tokens', 'skipped', 'input_ids', 'input_ids_key'],
+    'reference': ['reference'],
+    'model_outputs': ['model_outputs', 'model_output', 'inference_time', 'usage', 'cost', 'seed', 'generation_key', 'dedup_of'],
+    'extracted_results': ['extracted_results', 'extracted_result'],
+}
+
+def fingerprint(*values) -> str:
+    data = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+def output_stop_sequences(template, model) -> List[str]:
+    """Returns the stop sequences that change the model outputs (given explicitly and used by the model)."""
+    if model is None or not template.explicit_stop_sequences:
+        return []
+    return model.stop_sequences
+
+def prompt_fingerprint(template) -> str:
+    return fingerprint('prompt', template.prompt)
+
+def reference_fingerprint(template) -> str:
+    return fingerprint('reference', template.reference)
+
+def outputs_fingerprint(input_fingerprint, n=1, stop_sequences=()) -> str:
+    if stop_sequences:
+        return fingerprint('model_outputs', input_fingerprint, n, list(stop_sequences))
+    return fingerprint('model_outputs', input_fingerprint, n)
+
+def extract_fingerprint(template, model_outputs) -> str:
+    return fingerprint('extract', template.begin, template.end, model_outputs)
+
+def metric_fingerprint(evaluator, extracted_fingerprint, reference_fingerprint) -> str:
+    return fingerprint(evaluator.fingerprint(), extracted_fingerprint, reference_fingerprint)
+
+def stamp_stage(record: dict, stage, fp):
+    """Records the fingerprint of a stage output when the stage writes it (None is ignored)."""
+    if fp is not None:
+        record.setdefault('_fingerprints', {})[stage] = fp
+
+def stamp_outputs(record: dict, n=1, stop_sequences=()):
+    """Stamps model_outputs from the fingerprint of the prompt it was generated from."""
+    input_fingerprint = record.get('_fingerprints', {}).get('model_input')
+    if input_fingerprint is not None:
+        stamp_stage(record, 'model_outputs', outputs_fingerprint(input_fingerprint, n, stop_sequences))
+
+def stamp_metric(record: dict, evaluator):
+    """Stamps the score of the evaluator from the fingerprints of the extracted results and the reference."""
+    fps = record.get('_fingerprints', {})
+    if 'extracted_results' in fps and 'reference' in fps:
+        stamp_stage(record, evaluator.metric_id, metric_fingerprint(evaluator, fps['extracted_results'], fps['reference']))
+
+def expected_fingerprints(record: dict, template, evaluators=(), n=1, stop_sequences=()) -> dict:
+    """Computes the fingerprint each stage of the record should have (None if its inputs are missing)."""
+    fps = {}
+    fps['model_input'] = prompt_fingerprint(template)
+    fps['reference'] = reference_fingerprint(template)
+    fps['model_outputs'] = outputs_fingerprint(fps['model_input'], n, stop_sequences)
+    if 'model_outputs' in record:
+        fps['extracted_results'] = extract_fingerprint(template, record['model_outputs'])
+    else:
+        fps['extracted_results'] = None
+    for eval in evaluators:
+        if fps['extracted_results'] is None:
+            fps[eval.metric_id] = None
+        else:
+            fps[eval.metric_id] = metric_fingerprint(eval, fps['extracted_results'], fps['reference'])
+    return fps
+
+def _stage_keys(stage, evaluators):
+    for eval in evaluators:
+        if eval.metric_id == stage:
+            return [eval.metric_id] + list(eval.output_keys)
+    return STAGE_KEYS[stage]
+
+def invalidate_stale(records: List[dict], template, evaluators=(), n=1, stop_sequences=()) -> dict:
+    """
+    Removes stage outputs whose fingerprint has changed, cascading to downstream stages.
+    Stage outputs without fingerprints (older result files, crashed runs) cannot be trusted
+    and are removed as well.
+    """
+    invalidated = {}
+    for record in records:
+        stored = record.setdefault('_fingerprints', {})
+        fps = expected_fingerprints(record, template, evaluators, n, stop_sequences)
+        for stage in fps:
+            if stage not in stored:
+                if _stage_keys(stage, evaluators)[0] not in record:
+                    continue
+                # フィンガープリントのない出力は、どの設定で作られたかわからないので作り直す
+                stale = True
+            else:
+                # 上流のステージを消した場合は下流も消す
+                stale = fps[stage] is None or stored[stage] != fps[stage] or _upstream_removed(record, stage)
+            if stale:
+                for key in _stage_keys(stage, evaluators):
+                    record.pop(key, None)
+                stored.pop(stage, None)
+                invalidated[stage] = invalidated.get(stage, 0) + 1
+        if not stored:
+            del record['_fingerprints']
+    return invalidated
+
+def _upstream_removed(record, stage):
+    if stage == 'model_outputs':
+        return 'model_input' not in record
+    if stage == 'extracted_results':
+        return 'model_outputs' not in record
+    if stage not in STAGE_KEYS:
+        return 'extracted_results' not in record or 'reference' not in record
+    return False
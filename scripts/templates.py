@@ -200,6 +200,21 @@ class TemplateProcessor:
         self.reference = args['reference|=']
         self.begin = args['extract_begin']
         self.end = args['extract_end']
+        self.stop_sequences = self.guess_stop_sequences(args)
+        # extract_end から導いた停止文字列は、結果の再計算の判定 (フィンガープリント) に含めない
+        self.explicit_stop_sequences = args['stop_sequences|stop'] is not None
+
+    def guess_stop_sequences(self, args) -> List[str]:
+        """
+        Returns the stop sequences used to cut generation early.
+        Without stop_sequences, the line starting with extract_end ends the extraction.
+        """
+        stop_sequences = args['stop_sequences|stop']
+        if stop_sequences is None:
+            return ['\n' + self.end] if self.end else []
+        if isinstance(stop_sequences, str):
+            stop_sequences = stop_sequences.split('|')
+        return [stop for stop in stop_sequences if stop]
 
     def create_prompt(self, data):
         """Creates a prompt using the loaded template and provided data."""